@@ -1,21 +1,48 @@
 from fastapi import FastAPI, APIRouter, HTTPException, Depends, UploadFile, File, Request, Form
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
+from fastapi.encoders import jsonable_encoder
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, DESCENDING, TEXT, UpdateOne, ReturnDocument
+from pymongo.errors import BulkWriteError, OperationFailure, DuplicateKeyError
 import os
 import logging
+import enum
+import base64
 import hashlib
+import hmac
+import json
+import secrets
 import jwt
 import aiofiles
 from pathlib import Path
 from pydantic import BaseModel, Field
 from typing import List, Optional, Dict
 import uuid
+from functools import lru_cache
 from datetime import datetime, timezone, timedelta
 from user_agents import parse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from collections import OrderedDict, deque
+import asyncio
+import gzip
+import math
+import mimetypes
+import multiprocessing
+import re
+import stat
 import time
+import zlib
+from email.utils import formatdate, parsedate_to_datetime
+from urllib.parse import quote, urlencode
+from xml.sax.saxutils import escape
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # gallery derivatives are skipped without Pillow
+    Image = None
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -29,12 +56,133 @@ db = client[os.environ['DB_NAME']]
 UPLOAD_DIR = ROOT_DIR / "uploads"
 UPLOAD_DIR.mkdir(exist_ok=True)
 
+# Uploads are copied to disk in chunks of this size
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Resumable multi-part uploads keep their parts here until completed
+UPLOAD_PARTS_DIR = UPLOAD_DIR / ".parts"
+UPLOAD_PARTS_DIR.mkdir(exist_ok=True)
+UPLOAD_MAX_PARTS = 10000
+UPLOAD_CACHE_MAX_AGE = 86400  # files with uuid names; content-addressed names are cached for a year
+UPLOAD_MAX_RANGES = 16
+CONTENT_ADDRESSED_NAME = re.compile(r"^[0-9a-f]{64}(_\d+w)?(\.[A-Za-z0-9]+)?$")
+
+# Gallery derivatives: resized WebP variants plus a JPEG/PNG fallback, built in worker processes
+IMAGE_DERIVATIVE_WIDTHS = (320, 640, 1280)
+IMAGE_WORKERS = int(os.environ.get('IMAGE_WORKERS', 2))
+image_pool: Optional[ProcessPoolExecutor] = None
+IMAGE_DERIVATIVE_CLAIM_TIMEOUT = float(os.environ.get('IMAGE_DERIVATIVE_CLAIM_TIMEOUT', 600))  # pending longer than this = worker died
+background_tasks = set()
+
+UPLOAD_SESSION_TTL = int(os.environ.get('UPLOAD_SESSION_TTL', 86400))  # abandoned sessions are removed after this many seconds
+upload_gc_task: Optional[asyncio.Task] = None
+
 # Security
 JWT_SECRET = os.environ.get('JWT_SECRET', 'sectorfive-secure-secret-key-2024-CHANGE-THIS-IN-PRODUCTION')
 security = HTTPBearer()
 
-# Rate limiting storage (in production, use Redis)
-rate_limit_storage = {}
+# Rate limiting: "memory" keeps counters per process, "mongo" shares them between workers
+RATE_LIMIT_BACKEND = os.environ.get('RATE_LIMIT_BACKEND', 'memory')
+RATE_LIMIT_MAX_KEYS = 100000
+# In-memory caches and counters evict from the front when full; expired entries are swept on a timer
+CACHE_SWEEP_INTERVAL = float(os.environ.get('CACHE_SWEEP_INTERVAL', 60))
+cache_sweep_task: Optional[asyncio.Task] = None
+LOGIN_RATE_LIMIT = int(os.environ.get('LOGIN_RATE_LIMIT', 10))  # attempts per IP ...
+LOGIN_RATE_WINDOW = int(os.environ.get('LOGIN_RATE_WINDOW', 60))  # ... per this many seconds
+
+# Login throttling: after LOGIN_FREE_FAILURES failed attempts for a username or IP, further attempts
+# are locked out for LOGIN_BACKOFF_BASE * 2^n seconds (capped at LOGIN_LOCKOUT_MAX)
+LOGIN_FREE_FAILURES = int(os.environ.get('LOGIN_FREE_FAILURES', 3))
+LOGIN_BACKOFF_BASE = float(os.environ.get('LOGIN_BACKOFF_BASE', 2))
+LOGIN_LOCKOUT_MAX = float(os.environ.get('LOGIN_LOCKOUT_MAX', 900))
+LOGIN_FAILURE_TTL = 3600  # failure counts are forgotten after an hour without failures
+login_stats = {"evaluated": 0, "succeeded": 0, "failed": 0, "rejected_throttled": 0, "rejected_rate_limited": 0}
+
+# Password hashing: scrypt with a per-user salt, run in a thread pool so logins never block the event loop.
+# The cost is calibrated at startup to roughly PASSWORD_HASH_TARGET_MS per hash on this host.
+PASSWORD_HASH_TARGET_MS = float(os.environ.get('PASSWORD_HASH_TARGET_MS', 100))
+PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', min(4, os.cpu_count() or 1)))
+SCRYPT_R = 8
+SCRYPT_P = 1
+SCRYPT_MIN_LOG_N = 14
+SCRYPT_MAX_LOG_N = 17
+scrypt_log_n = SCRYPT_MIN_LOG_N
+password_pool = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="password-hash")
+default_credentials_check = {}  # admin password hash -> whether it is still "admin"
+dummy_password_hash: Optional[str] = None  # checked for unknown usernames so they cost the same
+
+# Settings cache: the validated Settings document, reloaded when its version changes
+SETTINGS_POLL_INTERVAL = float(os.environ.get('SETTINGS_POLL_INTERVAL', 5))
+settings_cache = {"settings": None, "version": None, "public_body": None, "public_etag": None}
+PUBLIC_SETTINGS_MAX_AGE = 60
+settings_poll_task: Optional[asyncio.Task] = None
+
+# Authorization cache: username -> (expiry, Principal)
+PERMISSION_CACHE_TTL = float(os.environ.get('PERMISSION_CACHE_TTL', 30))
+PERMISSION_CACHE_MAX_ENTRIES = 10000
+permission_cache = OrderedDict()  # oldest first
+
+# Listing totals: exact counts are cached per normalised query and dropped when the
+# collection is written; unfiltered listings can use the collection metadata count instead
+COUNT_STRATEGIES = ("exact", "estimated", "has_more")
+COUNT_STRATEGY_DEFAULTS = {
+    endpoint: os.environ.get(f'COUNT_STRATEGY_{endpoint.upper()}', os.environ.get('COUNT_STRATEGY', 'estimated'))
+    for endpoint in ("blog_search", "gallery", "contact_messages")
+}
+COUNT_CACHE_TTL = float(os.environ.get('COUNT_CACHE_TTL', 60))
+COUNT_CACHE_MAX_ENTRIES = 1000
+count_cache = OrderedDict()  # (collection, normalised query) -> (expiry, count), oldest first
+
+# Rendered public responses, see ResponseCache
+RESPONSE_CACHE_MAX_BYTES = int(os.environ.get('RESPONSE_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+RESPONSE_CACHE_TTL = float(os.environ.get('RESPONSE_CACHE_TTL', 30))
+RESPONSE_CACHE_STALE_TTL = float(os.environ.get('RESPONSE_CACHE_STALE_TTL', 300))
+RESPONSE_CACHE_DIR = os.environ.get('RESPONSE_CACHE_DIR')  # unset = memory only
+RESPONSE_CACHE_DISK_MAX_BYTES = int(os.environ.get('RESPONSE_CACHE_DISK_MAX_BYTES', 512 * 1024 * 1024))
+
+# Sitemap: bodies cached per content version, bumped by page and blog writes
+BASE_URL = os.environ.get('BASE_URL', 'https://example.com').rstrip('/')
+SITEMAP_MAX_URLS = 50000  # per file, as the sitemap protocol allows
+SITEMAP_MAX_AGE = 3600
+SITEMAP_CHUNK_SIZE = 64 * 1024
+sitemap_cache = {"version": None, "counts": None, "bodies": {}}  # bodies: name -> [xml, gzipped xml or None]
+
+# Token revocation: username -> current token_version, refreshed from MongoDB in the background
+TOKEN_VERSION_REFRESH_INTERVAL = float(os.environ.get('TOKEN_VERSION_REFRESH_INTERVAL', 5))
+token_versions = {}
+token_version_invalidations = {}  # username -> time.monotonic() of the last local invalidation
+token_version_task: Optional[asyncio.Task] = None
+
+# Analytics ingestion: visits are buffered in memory and written in batches
+ANALYTICS_BUFFER_SIZE = int(os.environ.get('ANALYTICS_BUFFER_SIZE', 10000))
+ANALYTICS_BATCH_SIZE = int(os.environ.get('ANALYTICS_BATCH_SIZE', 500))
+ANALYTICS_FLUSH_INTERVAL = float(os.environ.get('ANALYTICS_FLUSH_INTERVAL', 2.0))
+ANALYTICS_OVERFLOW_POLICY = os.environ.get('ANALYTICS_OVERFLOW_POLICY', 'drop_oldest')  # drop_oldest | drop_newest | block
+ANALYTICS_FLUSH_RETRIES = int(os.environ.get('ANALYTICS_FLUSH_RETRIES', 5))  # failed writes of a batch before it is dropped
+analytics_buffer = deque()
+analytics_stats = {"queued": 0, "flushed": 0, "dropped": 0, "failed": 0, "retried": 0, "batches": 0}
+analytics_flush_failures = 0  # consecutive failed writes of the batch at the front of the buffer
+analytics_flush_event = asyncio.Event()
+analytics_flush_lock = asyncio.Lock()
+analytics_flusher_task: Optional[asyncio.Task] = None
+
+# Analytics rollups: hourly/daily buckets plus an all-time total maintained as visits are flushed.
+# Bucket documents hold visits and a HyperLogLog sketch (at most HLL_REGISTERS fields); per-value
+# counters live in analytics_counters, one document per (granularity, bucket, dimension, value).
+ANALYTICS_DIMENSIONS = (("pages", "page_url"), ("countries", "country"), ("browsers", "browser"))
+ANALYTICS_ROLLUP_VERSION = 2  # rollups built in another layout are rebuilt at startup
+HLL_PRECISION = 11  # 2048 registers, ~2.3% standard error on unique visitors
+HLL_REGISTERS = 1 << HLL_PRECISION
+analytics_rollups_ready = False
+analytics_rollup_task: Optional[asyncio.Task] = None
+# The backfill heartbeats on its meta document; a backfill silent this long is taken over at startup
+ANALYTICS_ROLLUP_STALE_AFTER = float(os.environ.get('ANALYTICS_ROLLUP_STALE_AFTER', 300))
+analytics_rollup_owner = uuid.uuid4().hex  # identifies this process as the backfill owner
+ANALYTICS_OPTIONAL_FACETS = ("unique_visitors", "top_pages", "top_countries", "top_browsers")
+
+# Parsed user agents are memoised; a few hundred UA strings cover nearly all traffic
+USER_AGENT_CACHE_SIZE = int(os.environ.get('USER_AGENT_CACHE_SIZE', 4096))
+USER_AGENT_MAX_LENGTH = 1024  # longer strings are parsed but never cached
 
 app = FastAPI()
 api_router = APIRouter(prefix="/api")
@@ -92,10 +240,19 @@ class User(BaseModel):
     is_owner: bool = False  # The original admin user
     is_active: bool = True
     permissions: UserPermissions = Field(default_factory=UserPermissions)
+    token_version: int = 0  # bumped to revoke issued tokens
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     last_login: Optional[datetime] = None
     created_by: Optional[str] = None  # User ID who created this user
 
+class Principal(BaseModel):
+    """What authorization needs to know about a user, with permissions as a Permission bitmask"""
+    username: str
+    user_id: str
+    is_owner: bool = False
+    is_active: bool = True
+    permissions: int = 0
+
 class UserCreate(BaseModel):
     username: str
     email: str
@@ -172,6 +329,9 @@ class BlogSearchRequest(BaseModel):
     published_only: bool = True
     page: int = 1
     limit: int = 10
+    pagination: str = "offset"
+    cursor: Optional[str] = None
+    count: Optional[str] = None
 
 class Analytics(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -260,6 +420,9 @@ class GalleryImage(BaseModel):
     height: Optional[int] = None
     tags: List[str] = Field(default_factory=list)
     is_featured: bool = False
+    variants: List[Dict] = Field(default_factory=list)  # {"width", "height", "format", "filename", "file_size"}
+    derivatives_status: Optional[str] = None  # pending | ready | failed
+    derivatives_claimed_at: Optional[datetime] = None  # when a worker set pending
     uploaded_by: str
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
@@ -275,37 +438,220 @@ class GalleryImageUpdate(BaseModel):
     tags: List[str] = Field(default_factory=list)
     is_featured: bool = False
 
-# Helper functions
-def hash_password(password: str) -> str:
-    return hashlib.sha256(password.encode()).hexdigest()
+class UploadSession(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    filename: str
+    total_size: Optional[int] = None
+    status: str = "active"  # active | completed | aborted | expired
+    parts: Dict[str, Dict] = Field(default_factory=dict)  # part number -> {"size", "sha256"}
+    result_filename: Optional[str] = None
+    created_by: str
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
-def verify_password(password: str, hashed: str) -> bool:
-    return hash_password(password) == hashed
+class UploadSessionCreate(BaseModel):
+    filename: str
+    total_size: Optional[int] = None
 
-def create_token(username: str) -> str:
+# Helper functions
+def scrypt_hash(password: str, salt: bytes, log_n: int) -> bytes:
+    n = 1 << log_n
+    return hashlib.scrypt(password.encode(), salt=salt, n=n, r=SCRYPT_R, p=SCRYPT_P, maxmem=256 * SCRYPT_R * n, dklen=32)
+
+def calibrate_password_hashing() -> int:
+    """Largest scrypt cost whose hash time stays within PASSWORD_HASH_TARGET_MS"""
+    log_n = SCRYPT_MIN_LOG_N
+    while log_n < SCRYPT_MAX_LOG_N:
+        start = time.perf_counter()
+        scrypt_hash("calibration", b"0" * 16, log_n + 1)
+        if (time.perf_counter() - start) * 1000 > PASSWORD_HASH_TARGET_MS:
+            break
+        log_n += 1
+    return log_n
+
+def _hash_password_sync(password: str, log_n: int) -> str:
+    salt = secrets.token_bytes(16)
+    digest = scrypt_hash(password, salt, log_n)
+    return f"scrypt${log_n}${SCRYPT_R}${SCRYPT_P}${base64.b64encode(salt).decode()}${base64.b64encode(digest).decode()}"
+
+def _verify_password_sync(password: str, hashed: str) -> bool:
+    if not hashed.startswith("scrypt$"):
+        # Legacy unsalted SHA-256
+        return hmac.compare_digest(hashlib.sha256(password.encode()).hexdigest(), hashed)
+    _, log_n, r, p, salt, digest = hashed.split("$")
+    n = 1 << int(log_n)
+    candidate = hashlib.scrypt(password.encode(), salt=base64.b64decode(salt), n=n, r=int(r), p=int(p), maxmem=256 * int(r) * n, dklen=32)
+    return hmac.compare_digest(candidate, base64.b64decode(digest))
+
+async def hash_password(password: str) -> str:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(password_pool, _hash_password_sync, password, scrypt_log_n)
+
+async def verify_password(password: str, hashed: str) -> bool:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(password_pool, _verify_password_sync, password, hashed)
+
+def password_needs_rehash(hashed: str) -> bool:
+    """Legacy SHA-256 hashes and hashes weaker than the current cost are upgraded on login"""
+    if not hashed.startswith("scrypt$"):
+        return True
+    return int(hashed.split("$")[1]) < scrypt_log_n
+
+async def init_password_hashing():
+    global scrypt_log_n
+    loop = asyncio.get_running_loop()
+    scrypt_log_n = await loop.run_in_executor(password_pool, calibrate_password_hashing)
+    logging.getLogger(__name__).info(f"Password hashing: scrypt N=2^{scrypt_log_n}")
+    await get_dummy_password_hash(refresh=True)
+
+async def get_dummy_password_hash(refresh: bool = False) -> str:
+    """A hash of a random password at the current cost, never matched by any login"""
+    global dummy_password_hash
+    if dummy_password_hash is None or refresh:
+        dummy_password_hash = await hash_password(secrets.token_urlsafe(32))
+    return dummy_password_hash
+
+# Permissions are stored, cached, checked and put in tokens as a bitmask. Bit positions follow
+# the UserPermissions field order, so new permissions must only ever be appended.
+# page_edit_specific is set when the user has any specific pages; the page IDs live in permission_pages.
+PERMISSION_FLAGS = list(UserPermissions.model_fields)
+Permission = enum.IntFlag("Permission", {flag: 1 << index for index, flag in enumerate(PERMISSION_FLAGS)})
+
+def encode_permissions(permissions: UserPermissions) -> int:
+    mask = Permission(0)
+    for flag in PERMISSION_FLAGS:
+        if getattr(permissions, flag):
+            mask |= Permission[flag]
+    return int(mask)
+
+def permission_mask(user: dict) -> int:
+    permissions = user.get("permissions", 0)
+    if isinstance(permissions, dict):
+        # Written before permissions were stored as a bitmask
+        return encode_permissions(UserPermissions(**permissions))
+    return permissions
+
+def decode_permissions(user: dict) -> UserPermissions:
+    """API form of a user document's permissions"""
+    permissions = user.get("permissions", 0)
+    if isinstance(permissions, dict):
+        return UserPermissions(**permissions)
+    flags = {flag: bool(permissions & Permission[flag]) for flag in PERMISSION_FLAGS if flag != "page_edit_specific"}
+    return UserPermissions(**flags, page_edit_specific=user.get("permission_pages", []))
+
+def permission_fields(permissions: UserPermissions) -> dict:
+    """Storage form of a permission set, to be merged into a user document"""
+    return {"permissions": encode_permissions(permissions), "permission_pages": list(permissions.page_edit_specific)}
+
+def user_document(user: User) -> dict:
+    return {**user.dict(), **permission_fields(user.permissions)}
+
+def create_token(user: dict) -> str:
+    """Sign a token carrying a snapshot of the user's permissions and token version"""
     payload = {
-        "username": username,
+        "username": user["username"],
+        "uid": user["id"],
+        "own": user.get("is_owner", False),
+        "act": user.get("is_active", True),
+        "perm": permission_mask(user),
+        "ver": user.get("token_version", 0),
         "exp": datetime.now(timezone.utc) + timedelta(hours=24)
     }
     return jwt.encode(payload, JWT_SECRET, algorithm="HS256")
 
+async def token_version_is_current(username: str, version: int) -> bool:
+    current = token_versions.get(username)
+    if current is None or version > current:
+        # Not seen by the last refresh, or bumped since: e.g. created or re-issued on another worker
+        user = await db.users.find_one({"username": username}, {"token_version": 1})
+        if not user:
+            return False
+        current = token_versions[username] = user.get("token_version", 0)
+    return current == version
+
+async def refresh_token_versions():
+    global token_versions
+    started = time.monotonic()
+    fresh = {
+        user["username"]: user.get("token_version", 0)
+        async for user in db.users.find({}, {"username": 1, "token_version": 1})
+    }
+    # Users invalidated while the scan ran may have been read before their write landed
+    for username, invalidated_at in list(token_version_invalidations.items()):
+        if invalidated_at >= started:
+            fresh.pop(username, None)
+        else:
+            del token_version_invalidations[username]
+    token_versions = fresh
+
+async def token_version_refresher():
+    while True:
+        await asyncio.sleep(TOKEN_VERSION_REFRESH_INTERVAL)
+        try:
+            await refresh_token_versions()
+        except Exception as e:
+            logging.getLogger(__name__).error(f"Token version refresh failed: {e}")
+
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
     try:
         payload = jwt.decode(credentials.credentials, JWT_SECRET, algorithms=["HS256"])
         username = payload.get("username")
         if not username:
             raise HTTPException(status_code=401, detail="Invalid token")
-        return username
     except jwt.ExpiredSignatureError:
         raise HTTPException(status_code=401, detail="Token expired")
     except jwt.InvalidTokenError:
         raise HTTPException(status_code=401, detail="Invalid token")
+    if not await token_version_is_current(username, payload.get("ver", 0)):
+        raise HTTPException(status_code=401, detail="Token revoked")
+    # Any permission change bumps the version, so a current token's snapshot can be trusted
+    if "perm" in payload and username not in permission_cache:
+        permission_cache[username] = (time.monotonic() + PERMISSION_CACHE_TTL, Principal(
+            username=username,
+            user_id=payload["uid"],
+            is_owner=payload.get("own", False),
+            is_active=payload.get("act", True),
+            permissions=payload["perm"]
+        ))
+    return username
+
+def _parse_user_agent_uncached(user_agent_string: str) -> tuple:
+    user_agent = parse(user_agent_string)
+    return (
+        f"{user_agent.browser.family} {user_agent.browser.version_string}",
+        f"{user_agent.os.family} {user_agent.os.version_string}"
+    )
+
+_parse_user_agent_cached = lru_cache(maxsize=USER_AGENT_CACHE_SIZE)(_parse_user_agent_uncached)
+
+async def get_current_user_record(request: Request, current_user: str = Depends(get_current_user)) -> dict:
+    """The authenticated user's document, fetched at most once per request"""
+    user = getattr(request.state, "user", None)
+    if user is None:
+        user = await db.users.find_one({"username": current_user})
+        if not user:
+            raise HTTPException(status_code=404, detail="User not found")
+        request.state.user = user
+        # Permission checks later in this request reuse the fresh document
+        permission_cache[current_user] = (time.monotonic() + PERMISSION_CACHE_TTL, principal_from_user(user))
+    return user
 
 def parse_user_agent(user_agent_string: str) -> Dict[str, str]:
-    user_agent = parse(user_agent_string)
+    if len(user_agent_string) > USER_AGENT_MAX_LENGTH:
+        browser, os_name = _parse_user_agent_uncached(user_agent_string)
+    else:
+        browser, os_name = _parse_user_agent_cached(user_agent_string)
+    return {"browser": browser, "os": os_name}
+
+def user_agent_cache_stats() -> Dict[str, int]:
+    """Hit/miss/eviction counters for the user agent parse cache"""
+    info = _parse_user_agent_cached.cache_info()
     return {
-        "browser": f"{user_agent.browser.family} {user_agent.browser.version_string}",
-        "os": f"{user_agent.os.family} {user_agent.os.version_string}"
+        "hits": info.hits,
+        "misses": info.misses,
+        "evictions": max(info.misses - info.currsize, 0),
+        "size": info.currsize,
+        "max_size": info.maxsize
     }
 
 def get_country_from_ip(ip: str) -> str:
@@ -343,51 +689,559 @@ async def build_blog_search_query(search_request: BlogSearchRequest):
     if search_request.published_only:
         query["published"] = True
     
-    # Text search
-    search_conditions = []
+    # Text search, served by the weighted text index on blog_posts
     if search_request.query:
-        search_term = search_request.query
-        search_conditions.extend([
-            {"title": {"$regex": search_term, "$options": "i"}},
-            {"content": {"$regex": search_term, "$options": "i"}},
-            {"excerpt": {"$regex": search_term, "$options": "i"}},
-            {"tags": {"$regex": search_term, "$options": "i"}}
-        ])
+        query["$text"] = {"$search": search_request.query}
     
     # Tags filter
     if search_request.tags:
-        search_conditions.append({"tags": {"$in": search_request.tags}})
+        query["tags"] = {"$in": search_request.tags}
     
     # Author filter
     if search_request.author:
-        search_conditions.append({"author": {"$regex": search_request.author, "$options": "i"}})
+        query["author"] = {"$regex": re.escape(search_request.author), "$options": "i"}
     
     # Date range filter
-    date_conditions = []
+    date_range = {}
     if search_request.date_from:
-        date_conditions.append({"created_at": {"$gte": search_request.date_from}})
+        date_range["$gte"] = search_request.date_from
     if search_request.date_to:
-        date_conditions.append({"created_at": {"$lte": search_request.date_to}})
-    
-    # Combine all conditions
-    if search_conditions:
-        query["$or"] = search_conditions
-    if date_conditions:
-        query.update({k: v for d in date_conditions for k, v in d.items()})
+        date_range["$lte"] = search_request.date_to
+    if date_range:
+        query["created_at"] = date_range
     
     return query
 
-async def check_rate_limit(ip: str, endpoint: str, limit_seconds: int = 300):
+# Keyset pagination
+# Cursors are opaque tokens carrying the sort value and id of the row they point past,
+# so following one costs an index seek on (field, id) instead of skipping earlier rows.
+def encode_cursor(direction: str, value, doc_id: str) -> str:
+    if isinstance(value, str):
+        # Documents restored by older versions may still hold the ISO string
+        value = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    payload = json.dumps({"d": direction, "v": value.isoformat(), "id": doc_id}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str):
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        if payload["d"] not in ("next", "prev"):
+            raise ValueError(payload["d"])
+        return payload["d"], datetime.fromisoformat(payload["v"]), str(payload["id"])
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid pagination cursor")
+
+def use_cursor_pagination(pagination: str, cursor: Optional[str]) -> bool:
+    """Offset pagination stays the default; passing a cursor implies cursor mode"""
+    if pagination not in ("offset", "cursor"):
+        raise HTTPException(status_code=400, detail="pagination must be 'offset' or 'cursor'")
+    return pagination == "cursor" or cursor is not None
+
+async def keyset_page(collection, query: dict, field: str, cursor: Optional[str], limit: int, projection: dict = None):
+    """One page of matches ordered newest first by (field, id), with next/prev cursors"""
+    direction, value, doc_id = decode_cursor(cursor) if cursor else ("next", None, None)
+    order = DESCENDING if direction == "next" else ASCENDING
+    if value is not None:
+        op = "$lt" if direction == "next" else "$gt"
+        boundary = {"$or": [{field: {op: value}}, {field: value, "id": {op: doc_id}}]}
+        query = {"$and": [query, boundary]} if query else boundary
+    docs = await collection.find(query, projection).sort([(field, order), ("id", order)]).limit(limit + 1).to_list(length=limit + 1)
+    has_more = len(docs) > limit
+    docs = docs[:limit]
+    if direction == "prev":
+        docs.reverse()
+    # The side we came from always has rows, the side we are heading to has them if we overfetched
+    has_next = has_more if direction == "next" else value is not None
+    has_prev = value is not None if direction == "next" else has_more
+    next_cursor = encode_cursor("next", docs[-1][field], docs[-1]["id"]) if docs and has_next else None
+    prev_cursor = encode_cursor("prev", docs[0][field], docs[0]["id"]) if docs and has_prev else None
+    return docs, next_cursor, prev_cursor
+
+def cursor_pagination(limit: int, next_cursor: Optional[str], prev_cursor: Optional[str], total: Optional[int] = None) -> dict:
+    pagination = {
+        "per_page": limit,
+        "next_cursor": next_cursor,
+        "prev_cursor": prev_cursor,
+        "has_next": next_cursor is not None,
+        "has_prev": prev_cursor is not None
+    }
+    if total is not None:
+        pagination["total_results"] = total
+    return pagination
+
+# Listing totals
+def count_strategy(endpoint: str, requested: Optional[str]) -> str:
+    strategy = requested or COUNT_STRATEGY_DEFAULTS[endpoint]
+    if strategy not in COUNT_STRATEGIES:
+        raise HTTPException(status_code=400, detail=f"count must be one of: {', '.join(COUNT_STRATEGIES)}")
+    return strategy
+
+async def count_matches(collection, query: dict, strategy: str) -> Optional[int]:
+    """Total for a listing under the given strategy; None when the caller pages with has_more"""
+    if strategy == "has_more":
+        return None
+    if strategy == "estimated" and not query:
+        return await collection.estimated_document_count()
+    key = (collection.name, json.dumps(query, sort_keys=True, default=str))
+    now = time.monotonic()
+    cached = count_cache.get(key)
+    if cached and cached[0] > now:
+        return cached[1]
+    total = await collection.count_documents(query)
+    count_cache.pop(key, None)
+    while len(count_cache) >= COUNT_CACHE_MAX_ENTRIES:
+        count_cache.popitem(last=False)
+    count_cache[key] = (now + COUNT_CACHE_TTL, total)
+    return total
+
+def invalidate_counts(collection_name: str):
+    for key in [key for key in count_cache if key[0] == collection_name]:
+        del count_cache[key]
+
+async def fetch_offset_page(cursor, skip: int, limit: int, total: Optional[int]):
+    """Skip/limit page; without a total, one extra row tells whether another page exists"""
+    if total is not None:
+        docs = await cursor.skip(skip).limit(limit).to_list(length=limit)
+        return docs, skip + limit < total
+    docs = await cursor.skip(skip).limit(limit + 1).to_list(length=limit + 1)
+    return docs[:limit], len(docs) > limit
+
+# Response cache
+class ResponseCache:
+    """Serialised JSON responses keyed by route and declared query parameters.
+    
+    Entries are tagged with the content they were built from so writes drop exactly the
+    responses they affect. Memory is bounded by body bytes with LRU eviction, and evicted
+    entries spill to an optional disk tier, one directory per process. An expired entry
+    is still served for stale_ttl seconds while a background refresh rebuilds it.
+    """
+    def __init__(self, max_bytes: int, ttl: float, stale_ttl: float, disk_dir: Optional[str] = None, disk_max_bytes: int = 0):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_bytes // 16
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.disk_root = Path(disk_dir) if disk_dir else None
+        self.disk_dir = None  # this process's directory under disk_root, set by init_disk
+        self.disk_lock = None
+        self.disk_max_bytes = disk_max_bytes
+        self.entries = {}  # key -> entry, least recently used first
+        self.disk_entries = {}  # key -> entry without its body, oldest first
+        self.tags = {}  # tag -> keys held in either tier
+        self.bytes = 0
+        self.disk_bytes = 0
+        self.generation = 0  # bumped by invalidation so in-flight builds are not stored
+        self.refreshing = set()
+        self.stats = {"hits": 0, "stale_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0, "evictions": 0, "invalidations": 0, "refresh_failures": 0}
+    
+    def init_disk(self):
+        """Spilled entries do not survive a restart: their invalidations would have been missed.
+        
+        Every process spills into its own directory and holds an flock on <directory>.lock while
+        it runs, so directories whose lock can be taken belong to processes that are gone."""
+        import fcntl
+        import shutil
+        if self.disk_root is None:
+            return
+        self.disk_root.mkdir(parents=True, exist_ok=True)
+        for lock_path in self.disk_root.glob("[!.]*.lock"):
+            with open(lock_path, "a") as lock:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+                shutil.rmtree(lock_path.with_suffix(""), ignore_errors=True)
+                lock_path.unlink(missing_ok=True)
+        for path in self.disk_root.glob("*.json"):
+            # Spilled by versions that shared one directory between workers
+            path.unlink(missing_ok=True)
+        name = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        # Lock under a temporary name first so no other process sees the lock file unlocked
+        temp_lock_path = self.disk_root / f".{name}.lock"
+        self.disk_lock = open(temp_lock_path, "w")
+        fcntl.flock(self.disk_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        os.replace(temp_lock_path, self.disk_root / f"{name}.lock")
+        self.disk_dir = self.disk_root / name
+        self.disk_dir.mkdir()
+    
+    def close_disk(self):
+        import shutil
+        if self.disk_dir is None:
+            return
+        shutil.rmtree(self.disk_dir, ignore_errors=True)
+        self.disk_dir.with_suffix(".lock").unlink(missing_ok=True)
+        self.disk_lock.close()
+        self.disk_dir = None
+        self.disk_entries.clear()
+        self.disk_bytes = 0
+    
+    def _disk_path(self, key: str) -> Path:
+        return self.disk_dir / f"{hashlib.sha256(key.encode()).hexdigest()}.json"
+    
+    def _drop(self, key: str):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry["size"]
+        else:
+            entry = self.disk_entries.pop(key, None)
+            if entry is None:
+                return
+            self.disk_bytes -= entry["size"]
+            self._disk_path(key).unlink(missing_ok=True)
+        for tag in entry["tags"]:
+            keys = self.tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.tags[tag]
+    
+    async def _load_from_disk(self, key: str) -> Optional[dict]:
+        entry = self.disk_entries.pop(key)
+        self.disk_bytes -= entry["size"]
+        path = self._disk_path(key)
+        try:
+            async with aiofiles.open(path, "rb") as f:
+                body = await f.read()
+        except OSError:
+            self.disk_entries[key] = entry
+            self.disk_bytes += entry["size"]
+            self._drop(key)
+            return None
+        path.unlink(missing_ok=True)
+        self.stats["disk_hits"] += 1
+        return {**entry, "body": body}
+    
+    async def _spill(self, key: str, entry: dict):
+        try:
+            async with aiofiles.open(self._disk_path(key), "wb") as f:
+                await f.write(entry["body"])
+        except OSError as e:
+            logging.getLogger(__name__).warning(f"Response cache spill failed: {e}")
+            self.entries[key] = entry
+            self.bytes += entry["size"]
+            self._drop(key)
+            return
+        self.disk_entries[key] = {k: v for k, v in entry.items() if k != "body"}
+        self.disk_bytes += entry["size"]
+        while self.disk_bytes > self.disk_max_bytes and self.disk_entries:
+            self._drop(next(iter(self.disk_entries)))
+    
+    async def _evict(self):
+        while self.bytes > self.max_bytes and self.entries:
+            key = next(iter(self.entries))
+            self.stats["evictions"] += 1
+            if self.disk_dir is None:
+                self._drop(key)
+                continue
+            entry = self.entries.pop(key)
+            self.bytes -= entry["size"]
+            await self._spill(key, entry)
+    
+    async def lookup(self, key: str):
+        """(entry, fresh) for a cached response, or (None, False) on a miss"""
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.entries[key] = entry  # most recently used
+        elif key in self.disk_entries:
+            entry = await self._load_from_disk(key)
+            if entry is not None:
+                self.entries[key] = entry
+                self.bytes += entry["size"]
+                await self._evict()
+        if entry is None:
+            self.stats["misses"] += 1
+            return None, False
+        age = time.monotonic() - entry["stored_at"]
+        if age > self.ttl + self.stale_ttl:
+            self._drop(key)
+            self.stats["misses"] += 1
+            return None, False
+        fresh = age <= self.ttl
+        self.stats["hits" if fresh else "stale_hits"] += 1
+        return entry, fresh
+    
+    async def fill(self, key: str, build) -> dict:
+        """Build a response with build() -> (payload, tags, headers) and store it"""
+        generation = self.generation
+        payload, tags, headers = await build()
+        body = json.dumps(jsonable_encoder(payload), ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode()
+        entry = {"body": body, "headers": headers or {}, "tags": tuple(tags), "stored_at": time.monotonic(), "size": len(body) + len(key)}
+        if generation == self.generation and entry["size"] <= self.max_entry_bytes:
+            self._drop(key)
+            self.entries[key] = entry
+            self.bytes += entry["size"]
+            for tag in entry["tags"]:
+                self.tags.setdefault(tag, set()).add(key)
+            self.stats["stores"] += 1
+            await self._evict()
+        return entry
+    
+    def revalidate(self, key: str, build):
+        if key not in self.refreshing:
+            self.refreshing.add(key)
+            run_in_background(self._refresh(key, build))
+    
+    async def _refresh(self, key: str, build):
+        try:
+            await self.fill(key, build)
+        except HTTPException:
+            # The content is gone (or hidden) now
+            self._drop(key)
+        except Exception as e:
+            self.stats["refresh_failures"] += 1
+            logging.getLogger(__name__).warning(f"Response cache refresh failed for {key}: {e}")
+        finally:
+            self.refreshing.discard(key)
+    
+    def invalidate(self, *tags: str):
+        self.generation += 1
+        for tag in tags:
+            for key in list(self.tags.get(tag, ())):
+                self._drop(key)
+                self.stats["invalidations"] += 1
+    
+    def clear(self):
+        self.generation += 1
+        for key in list(self.entries) + list(self.disk_entries):
+            self._drop(key)
+    
+    def metrics(self) -> dict:
+        lookups = self.stats["hits"] + self.stats["stale_hits"] + self.stats["misses"]
+        return {
+            **self.stats,
+            "hit_ratio": (self.stats["hits"] + self.stats["stale_hits"]) / lookups if lookups else None,
+            "entries": len(self.entries),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "disk_entries": len(self.disk_entries),
+            "disk_bytes": self.disk_bytes
+        }
+
+response_cache = ResponseCache(RESPONSE_CACHE_MAX_BYTES, RESPONSE_CACHE_TTL, RESPONSE_CACHE_STALE_TTL, RESPONSE_CACHE_DIR, RESPONSE_CACHE_DISK_MAX_BYTES)
+
+async def cached_json_response(request: Request, build) -> Response:
+    """Serve a public GET through response_cache; build() -> (payload, tags, headers)"""
+    # Only parameters the endpoint declares can change the response; others would just split the cache
+    declared = {param.alias for param in request.scope["route"].dependant.query_params}
+    params = sorted((name, value) for name, value in request.query_params.multi_items() if name in declared)
+    key = f"{request.url.path}?{urlencode(params)}"
+    entry, fresh = await response_cache.lookup(key)
+    if entry is None:
+        entry, state = await response_cache.fill(key, build), "miss"
+    elif fresh:
+        state = "hit"
+    else:
+        state = "stale"
+        response_cache.revalidate(key, build)
+    return Response(content=entry["body"], media_type="application/json", headers={**entry["headers"], "x-cache": state})
+
+# Rate limiting
+# Each backend implements both algorithms and returns None when the request is allowed,
+# otherwise the number of seconds until it would be.
+class MemoryRateLimitBackend:
+    """Per-process counters with TTL eviction and a hard cap on tracked keys"""
+    def __init__(self, max_keys: int = RATE_LIMIT_MAX_KEYS):
+        self.max_keys = max_keys
+        self.entries = OrderedDict()  # key -> (expires_at, state)
+    
+    def _get(self, key: str, now: float):
+        entry = self.entries.pop(key, None)
+        return entry[1] if entry and entry[0] > now else None
+    
+    def _put(self, key: str, state, expires_at: float):
+        while len(self.entries) >= self.max_keys:
+            # Least recently used first: entries are re-inserted on every hit
+            self.entries.popitem(last=False)
+        self.entries[key] = (expires_at, state)
+    
+    def sweep(self):
+        now = time.time()
+        for key in [key for key, (expiry, _) in self.entries.items() if expiry <= now]:
+            del self.entries[key]
+    
+    async def sliding_window(self, key: str, limit: int, window: float) -> Optional[float]:
+        now = time.time()
+        hits = [hit for hit in (self._get(key, now) or []) if hit > now - window]
+        retry_after = None
+        if len(hits) >= limit:
+            retry_after = hits[0] + window - now
+        else:
+            hits.append(now)
+        self._put(key, hits, hits[-1] + window)
+        return retry_after
+    
+    async def token_bucket(self, key: str, capacity: int, window: float) -> Optional[float]:
+        now = time.time()
+        refill_rate = capacity / window
+        tokens, updated = self._get(key, now) or (capacity, now)
+        tokens = min(capacity, tokens + (now - updated) * refill_rate)
+        retry_after = None
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            retry_after = (1 - tokens) / refill_rate
+        self._put(key, (tokens, now), now + (capacity - tokens) / refill_rate)
+        return retry_after
+
+class MongoRateLimitBackend:
+    """Counters shared by all workers, updated atomically with pipeline updates and expired by a TTL index"""
+    def __init__(self, collection):
+        self.collection = collection
+    
+    async def sliding_window(self, key: str, limit: int, window: float) -> Optional[float]:
+        now = datetime.now(timezone.utc)
+        state = await self.collection.find_one_and_update(
+            {"_id": f"sw:{key}"},
+            [
+                {"$set": {"hits": {"$filter": {
+                    "input": {"$ifNull": ["$hits", []]},
+                    "cond": {"$gt": ["$$this", now - timedelta(seconds=window)]}
+                }}}},
+                {"$set": {"allowed": {"$lt": [{"$size": "$hits"}, limit]}}},
+                {"$set": {
+                    "hits": {"$cond": ["$allowed", {"$concatArrays": ["$hits", [now]]}, "$hits"]},
+                    "expires_at": now + timedelta(seconds=window)
+                }}
+            ],
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        if state["allowed"]:
+            return None
+        oldest = state["hits"][0].replace(tzinfo=timezone.utc)
+        return (oldest - now).total_seconds() + window
+    
+    async def token_bucket(self, key: str, capacity: int, window: float) -> Optional[float]:
+        now = datetime.now(timezone.utc)
+        refill_rate = capacity / window
+        elapsed = {"$divide": [{"$subtract": [now, {"$ifNull": ["$updated", now]}]}, 1000]}
+        state = await self.collection.find_one_and_update(
+            {"_id": f"tb:{key}"},
+            [
+                {"$set": {"tokens": {"$min": [capacity, {"$add": [{"$ifNull": ["$tokens", capacity]}, {"$multiply": [elapsed, refill_rate]}]}]}}},
+                {"$set": {"allowed": {"$gte": ["$tokens", 1]}}},
+                {"$set": {
+                    "tokens": {"$cond": ["$allowed", {"$subtract": ["$tokens", 1]}, "$tokens"]},
+                    "updated": now,
+                    "expires_at": now + timedelta(seconds=window)
+                }}
+            ],
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        if state["allowed"]:
+            return None
+        return (1 - state["tokens"]) / refill_rate
+
+rate_limiter = MongoRateLimitBackend(db.rate_limits) if RATE_LIMIT_BACKEND == "mongo" else MemoryRateLimitBackend()
+
+def login_lockout_seconds(failures: int) -> float:
+    if failures < LOGIN_FREE_FAILURES:
+        return 0
+    return min(LOGIN_BACKOFF_BASE * 2 ** (failures - LOGIN_FREE_FAILURES), LOGIN_LOCKOUT_MAX)
+
+class LoginThrottle:
+    """Failed-login counters per username and per IP, kept in memory or shared through MongoDB"""
+    def __init__(self, collection=None, max_keys: int = RATE_LIMIT_MAX_KEYS):
+        self.collection = collection
+        self.max_keys = max_keys
+        self.entries = OrderedDict()  # key -> (failures, locked_until, expires_at), oldest first
+    
+    async def retry_after(self, keys: List[str]) -> Optional[float]:
+        """Seconds until the attempt would be evaluated, or None if it may proceed now"""
+        now = time.time()
+        if self.collection is not None:
+            locked_until = [
+                entry["locked_until"].replace(tzinfo=timezone.utc).timestamp()
+                async for entry in self.collection.find({"_id": {"$in": keys}}, {"locked_until": 1})
+                if entry.get("locked_until") is not None
+            ]
+        else:
+            locked_until = [self.entries[key][1] for key in keys if key in self.entries and self.entries[key][2] > now]
+        wait = max(locked_until, default=0) - now
+        return wait if wait > 0 else None
+    
+    async def record_failure(self, keys: List[str]):
+        now = time.time()
+        if self.collection is not None:
+            current = datetime.now(timezone.utc)
+            # login_lockout_seconds, evaluated server-side so the count and the lockout land in one round-trip
+            lockout = {"$cond": [
+                {"$lt": ["$failures", LOGIN_FREE_FAILURES]},
+                0,
+                {"$min": [
+                    {"$multiply": [LOGIN_BACKOFF_BASE, {"$pow": [2, {"$subtract": ["$failures", LOGIN_FREE_FAILURES]}]}]},
+                    LOGIN_LOCKOUT_MAX
+                ]}
+            ]}
+            for key in keys:
+                await self.collection.find_one_and_update(
+                    {"_id": key},
+                    [
+                        {"$set": {"failures": {"$add": [
+                            {"$cond": [{"$gt": [{"$ifNull": ["$expires_at", current]}, current]}, {"$ifNull": ["$failures", 0]}, 0]},
+                            1
+                        ]}}},
+                        {"$set": {
+                            "locked_until": {"$add": [current, {"$multiply": [lockout, 1000]}]},
+                            "expires_at": current + timedelta(seconds=LOGIN_FAILURE_TTL)
+                        }}
+                    ],
+                    upsert=True,
+                    return_document=ReturnDocument.AFTER
+                )
+            return
+        for key in keys:
+            entry = self.entries.pop(key, None)
+            failures = (entry[0] if entry and entry[2] > now else 0) + 1
+            while len(self.entries) >= self.max_keys:
+                self.entries.popitem(last=False)
+            self.entries[key] = (failures, now + login_lockout_seconds(failures), now + LOGIN_FAILURE_TTL)
+    
+    async def reset(self, key: str):
+        if self.collection is not None:
+            await self.collection.delete_one({"_id": key})
+        else:
+            self.entries.pop(key, None)
+    
+    def sweep(self):
+        now = time.time()
+        for key in [key for key, (_, _, expiry) in self.entries.items() if expiry <= now]:
+            del self.entries[key]
+
+login_throttle = LoginThrottle(db.login_failures if RATE_LIMIT_BACKEND == "mongo" else None)
+
+def sweep_expired(cache: Dict, now: float):
+    """Drop (expiry, value) entries that have expired"""
+    for key in [key for key, (expiry, _) in cache.items() if expiry <= now]:
+        del cache[key]
+
+async def cache_sweeper():
+    """Periodically drop expired entries, keeping full scans off the request path"""
+    while True:
+        await asyncio.sleep(CACHE_SWEEP_INTERVAL)
+        try:
+            if isinstance(rate_limiter, MemoryRateLimitBackend):
+                rate_limiter.sweep()
+            login_throttle.sweep()
+            sweep_expired(permission_cache, time.monotonic())
+            sweep_expired(count_cache, time.monotonic())
+        except Exception as e:
+            logging.getLogger(__name__).error(f"Cache sweep failed: {e}")
+
+async def check_rate_limit(ip: str, endpoint: str, limit_seconds: int = 300, max_requests: int = 1, algorithm: str = "sliding_window"):
+    """Allow max_requests per limit_seconds for ip on endpoint, raising 429 beyond that"""
     key = f"{ip}:{endpoint}"
-    current_time = time.time()
-    if key in rate_limit_storage:
-        last_request = rate_limit_storage[key]
-        if current_time - last_request < limit_seconds:
-            raise HTTPException(
-                status_code=429,
-                detail=f"Rate limit exceeded. Please wait {int(limit_seconds - (current_time - last_request))} seconds."
-            )
-    rate_limit_storage[key] = current_time
+    if algorithm == "token_bucket":
+        retry_after = await rate_limiter.token_bucket(key, max_requests, limit_seconds)
+    else:
+        retry_after = await rate_limiter.sliding_window(key, max_requests, limit_seconds)
+    if retry_after is not None:
+        wait = max(1, math.ceil(retry_after))
+        raise HTTPException(
+            status_code=429,
+            detail=f"Rate limit exceeded. Please wait {wait} seconds.",
+            headers={"Retry-After": str(wait)}
+        )
 
 async def track_visit(request: Request, page_url: str):
     client_ip = request.client.host
@@ -404,7 +1258,547 @@ async def track_visit(request: Request, page_url: str):
         browser=agent_info["browser"],
         os=agent_info["os"]
     )
-    await db.analytics.insert_one(analytics_data.dict())
+    await enqueue_analytics(analytics_data.dict())
+
+async def enqueue_analytics(record: dict):
+    """Buffer an analytics record for the background flusher"""
+    if len(analytics_buffer) >= ANALYTICS_BUFFER_SIZE:
+        if ANALYTICS_OVERFLOW_POLICY == "drop_newest":
+            analytics_stats["dropped"] += 1
+            return
+        if ANALYTICS_OVERFLOW_POLICY == "block":
+            # Backpressure: the request pays for one batch write to make room
+            await flush_analytics(max_batches=1)
+        if len(analytics_buffer) >= ANALYTICS_BUFFER_SIZE:
+            analytics_buffer.popleft()
+            analytics_stats["dropped"] += 1
+    analytics_buffer.append(record)
+    analytics_stats["queued"] += 1
+    if len(analytics_buffer) >= ANALYTICS_BATCH_SIZE:
+        analytics_flush_event.set()
+
+def requeue_analytics(batch: List[dict]):
+    """Put a batch that could not be written back at the front of the buffer, within ANALYTICS_BUFFER_SIZE"""
+    overflow = len(batch) + len(analytics_buffer) - ANALYTICS_BUFFER_SIZE
+    if overflow > 0:
+        if ANALYTICS_OVERFLOW_POLICY == "drop_newest":
+            for _ in range(min(overflow, len(analytics_buffer))):
+                analytics_buffer.pop()
+        else:
+            # The batch holds the oldest records
+            batch = batch[overflow:]
+        analytics_stats["dropped"] += overflow
+    analytics_buffer.extendleft(reversed(batch))
+
+async def flush_analytics(max_batches: Optional[int] = None):
+    """Write buffered analytics records to MongoDB with insert_many"""
+    global analytics_flush_failures
+    async with analytics_flush_lock:
+        batches = 0
+        while analytics_buffer and (max_batches is None or batches < max_batches):
+            batch = [analytics_buffer.popleft() for _ in range(min(ANALYTICS_BATCH_SIZE, len(analytics_buffer)))]
+            analytics_stats["batches"] += 1
+            batches += 1
+            try:
+                await db.analytics.insert_many(batch, ordered=False)
+                written, unwritten = batch, []
+            except BulkWriteError as e:
+                # insert_many has given every record an _id, so records written by an earlier attempt
+                # come back as duplicate keys and count as written
+                failed = {error["index"] for error in e.details.get("writeErrors", []) if error.get("code") != 11000}
+                written = [record for index, record in enumerate(batch) if index not in failed]
+                unwritten = [record for index, record in enumerate(batch) if index in failed]
+                error = e
+            except Exception as e:
+                written, unwritten = [], batch
+                error = e
+            if written:
+                analytics_stats["flushed"] += len(written)
+                try:
+                    await update_analytics_rollups(written)
+                except Exception as e:
+                    logging.getLogger(__name__).error(f"Analytics rollup update failed: {e}")
+            if not unwritten:
+                analytics_flush_failures = 0
+                continue
+            analytics_flush_failures += 1
+            if analytics_flush_failures >= ANALYTICS_FLUSH_RETRIES:
+                analytics_flush_failures = 0
+                analytics_stats["failed"] += len(unwritten)
+                logging.getLogger(__name__).error(f"Analytics flush failed {ANALYTICS_FLUSH_RETRIES} times, {len(unwritten)} records lost: {error}")
+                continue
+            analytics_stats["retried"] += len(unwritten)
+            logging.getLogger(__name__).warning(f"Analytics flush failed, {len(unwritten)} records kept for retry: {error}")
+            requeue_analytics(unwritten)
+            # Leave the rest for the next flush rather than hammering a database that just failed
+            break
+
+async def analytics_flusher():
+    """Background task flushing the analytics buffer on size or time thresholds"""
+    while True:
+        try:
+            await asyncio.wait_for(analytics_flush_event.wait(), timeout=ANALYTICS_FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        analytics_flush_event.clear()
+        try:
+            await flush_analytics()
+        except Exception as e:
+            logging.getLogger(__name__).error(f"Analytics flusher error: {e}")
+
+async def start_analytics_flusher():
+    global analytics_flusher_task
+    if analytics_flusher_task is None or analytics_flusher_task.done():
+        analytics_flusher_task = asyncio.create_task(analytics_flusher())
+
+async def stop_analytics_flusher():
+    """Stop the background flusher and write whatever is still buffered"""
+    global analytics_flusher_task
+    if analytics_flusher_task is not None:
+        analytics_flusher_task.cancel()
+        try:
+            await analytics_flusher_task
+        except asyncio.CancelledError:
+            pass
+        analytics_flusher_task = None
+    await flush_analytics()
+
+# Analytics rollups
+def hll_register(value: str) -> tuple:
+    """HyperLogLog register index and rank for a value"""
+    h = int.from_bytes(hashlib.sha1(value.encode()).digest()[:8], "big")
+    index = h >> (64 - HLL_PRECISION)
+    remainder = h & ((1 << (64 - HLL_PRECISION)) - 1)
+    return index, (64 - HLL_PRECISION) - remainder.bit_length() + 1
+
+def hll_estimate(registers: Dict[str, int]) -> int:
+    """Cardinality estimate from sparse HyperLogLog registers"""
+    m = HLL_REGISTERS
+    zeros = m - len(registers)
+    harmonic = sum(2.0 ** -rank for rank in registers.values()) + zeros
+    estimate = (0.7213 / (1 + 1.079 / m)) * m * m / harmonic
+    if estimate <= 2.5 * m and zeros:
+        estimate = m * math.log(m / zeros)
+    return int(round(estimate))
+
+def rollup_buckets(timestamp: datetime) -> List[tuple]:
+    hour = timestamp.replace(minute=0, second=0, microsecond=0)
+    return [("hour", hour), ("day", hour.replace(hour=0)), ("total", None)]
+
+def rollup_id(granularity: str, bucket: Optional[datetime]) -> str:
+    return f"{granularity}:{bucket.isoformat()}" if bucket else granularity
+
+async def update_analytics_rollups(records: List[dict]):
+    """Fold a batch of visits into their hourly and daily rollup buckets"""
+    updates = {}
+    counters = {}  # (granularity, bucket, dimension, value) -> count
+    for record in records:
+        timestamp = record["timestamp"]
+        if isinstance(timestamp, str):
+            timestamp = datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
+        if timestamp.tzinfo is not None:
+            # Live flushes carry aware datetimes, the backfill reads naive UTC ones from Motor;
+            # both must land in the same bucket _id
+            timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+        index, rank = hll_register(record.get("ip_address") or "")
+        for granularity, bucket in rollup_buckets(timestamp):
+            update = updates.setdefault((granularity, bucket), {"$inc": {"visits": 0}, "$max": {}})
+            update["$inc"]["visits"] += 1
+            path = f"hll.{index}"
+            if rank > update["$max"].get(path, 0):
+                update["$max"][path] = rank
+            for dimension, field in ANALYTICS_DIMENSIONS:
+                key = (granularity, bucket, dimension, record.get(field))
+                counters[key] = counters.get(key, 0) + 1
+    if not updates:
+        return
+    await db.analytics_rollups.bulk_write([
+        UpdateOne(
+            {"_id": rollup_id(granularity, bucket)},
+            {**update, "$setOnInsert": {"granularity": granularity, "bucket": bucket}},
+            upsert=True
+        )
+        for (granularity, bucket), update in updates.items()
+    ], ordered=False)
+    await db.analytics_counters.bulk_write([
+        UpdateOne(
+            {"granularity": granularity, "bucket": bucket, "dimension": dimension, "value": value},
+            {"$inc": {"count": count}},
+            upsert=True
+        )
+        for (granularity, bucket, dimension, value), count in counters.items()
+    ], ordered=False)
+
+async def analytics_rollup_heartbeat(**fields) -> bool:
+    """Refresh the backfill heartbeat, False once another worker has taken the backfill over"""
+    result = await db.analytics_rollups.update_one(
+        {"_id": "meta", "owner": analytics_rollup_owner},
+        {"$set": {"heartbeat": datetime.now(timezone.utc), **fields}}
+    )
+    return result.matched_count > 0
+
+async def rebuild_analytics_rollups(cutoff: datetime, batch_size: int = 1000):
+    """Backfill rollups from raw visits recorded before cutoff"""
+    global analytics_rollups_ready
+    logger = logging.getLogger(__name__)
+    try:
+        batch = []
+        async for visit in db.analytics.find({"timestamp": {"$lt": cutoff}}, {"_id": 0, "timestamp": 1, "ip_address": 1, "page_url": 1, "country": 1, "browser": 1}):
+            batch.append(visit)
+            if len(batch) >= batch_size:
+                await update_analytics_rollups(batch)
+                batch = []
+                if not await analytics_rollup_heartbeat():
+                    logger.warning("Analytics rollup backfill taken over by another worker, stopping")
+                    return
+        if batch:
+            await update_analytics_rollups(batch)
+        if not await analytics_rollup_heartbeat(complete=True):
+            logger.warning("Analytics rollup backfill taken over by another worker, stopping")
+            return
+    except Exception as e:
+        # The heartbeat goes stale and the next startup starts the backfill over
+        logger.error(f"Analytics rollup backfill failed: {e}")
+        return
+    analytics_rollups_ready = True
+    logger.info("Analytics rollups rebuilt")
+
+async def repair_analytics_timestamps(batch_size: int = 1000):
+    """Convert visit timestamps left as ISO strings by older restores, so range queries and cursors see them"""
+    operations = []
+    repaired = 0
+    async for visit in db.analytics.find({"timestamp": {"$type": "string"}}, {"_id": 1, "timestamp": 1}):
+        try:
+            timestamp = datetime.fromisoformat(visit["timestamp"].replace('Z', '+00:00'))
+        except ValueError:
+            continue
+        operations.append(UpdateOne({"_id": visit["_id"]}, {"$set": {"timestamp": timestamp}}))
+        if len(operations) >= batch_size:
+            await db.analytics.bulk_write(operations, ordered=False)
+            repaired += len(operations)
+            operations = []
+    if operations:
+        await db.analytics.bulk_write(operations, ordered=False)
+        repaired += len(operations)
+    if repaired:
+        logging.getLogger(__name__).info(f"Converted {repaired} analytics timestamps stored as strings")
+
+async def init_analytics_rollups():
+    """Start the backfill if no worker has built the rollups yet, or take over one that stopped"""
+    global analytics_rollup_task
+    now = datetime.now(timezone.utc)
+    meta = {"_id": "meta", "complete": False, "cutoff": now, "owner": analytics_rollup_owner, "heartbeat": now, "version": ANALYTICS_ROLLUP_VERSION}
+    try:
+        await db.analytics_rollups.insert_one(meta)
+    except DuplicateKeyError:
+        # A backfill whose worker died, e.g. during a rolling deploy, would otherwise never finish
+        stale_heartbeat = now - timedelta(seconds=ANALYTICS_ROLLUP_STALE_AFTER)
+        stale = await db.analytics_rollups.find_one_and_update(
+            {"_id": "meta", "$or": [
+                {"complete": False, "heartbeat": {"$lt": stale_heartbeat}},
+                {"complete": False, "heartbeat": {"$exists": False}},
+                {"version": {"$ne": ANALYTICS_ROLLUP_VERSION}}
+            ]},
+            {"$set": meta}
+        )
+        if stale is None:
+            return
+        if stale.get("version") != ANALYTICS_ROLLUP_VERSION:
+            logging.getLogger(__name__).warning("Analytics rollups use an older layout, rebuilding them")
+        else:
+            logging.getLogger(__name__).warning("Analytics rollup backfill stopped without finishing, starting it over")
+        await reset_analytics_rollups()
+        return
+    analytics_rollup_task = asyncio.create_task(rebuild_analytics_rollups(now))
+
+async def reset_analytics_rollups():
+    """Drop all rollup buckets and backfill them again from raw visits"""
+    global analytics_rollups_ready
+    analytics_rollups_ready = False
+    await db.analytics_rollups.delete_many({})
+    await db.analytics_counters.delete_many({})
+    await init_analytics_rollups()
+
+async def analytics_rollups_available() -> bool:
+    global analytics_rollups_ready
+    if not analytics_rollups_ready:
+        meta = await db.analytics_rollups.find_one({"_id": "meta"})
+        analytics_rollups_ready = bool(meta and meta.get("complete") and meta.get("version") == ANALYTICS_ROLLUP_VERSION)
+    return analytics_rollups_ready
+
+async def get_rollup_summary(top_n: int = 10) -> dict:
+    """All-time dashboard totals from the precomputed total bucket and its counters"""
+    async def top(dimension):
+        counters = db.analytics_counters.find(
+            {"granularity": "total", "bucket": None, "dimension": dimension},
+            {"_id": 0, "value": 1, "count": 1}
+        ).sort("count", -1).limit(top_n)
+        return [{"_id": counter["value"], "count": counter["count"]} async for counter in counters]
+    total, top_pages, top_countries, top_browsers = await asyncio.gather(
+        db.analytics_rollups.find_one({"_id": rollup_id("total", None)}),
+        top("pages"),
+        top("countries"),
+        top("browsers")
+    )
+    total = total or {}
+    total_visits = total.get("visits", 0)
+    return {
+        "total_visits": total_visits,
+        "unique_visitors": hll_estimate(total.get("hll", {})) if total_visits else 0,
+        "top_pages": top_pages,
+        "top_countries": top_countries,
+        "top_browsers": top_browsers
+    }
+
+async def get_analytics_facets(query: dict, skip: int, limit: int, skipped: set = frozenset(), include_visits: bool = True) -> dict:
+    """Dashboard statistics for a filtered visit set in a single $facet pass"""
+    def top(field):
+        return [{"$group": {"_id": f"${field}", "count": {"$sum": 1}}}, {"$sort": {"count": -1}}, {"$limit": 10}]
+    facets = {
+        "total_visits": [{"$count": "count"}],
+        "recent_visits": [{"$sort": {"timestamp": -1, "id": -1}}, {"$skip": skip}, {"$limit": limit}],
+        "unique_visitors": [{"$group": {"_id": "$ip_address"}}, {"$count": "count"}],
+        "top_pages": top("page_url"),
+        "top_countries": top("country"),
+        "top_browsers": top("browser")
+    }
+    for facet in skipped & set(ANALYTICS_OPTIONAL_FACETS):
+        del facets[facet]
+    if not include_visits:
+        del facets["recent_visits"]
+    pipeline = [{"$match": query}, {"$facet": facets}]
+    result = (await db.analytics.aggregate(pipeline, allowDiskUse=True).to_list(length=1))[0]
+    summary = {facet: None for facet in ANALYTICS_OPTIONAL_FACETS}
+    for facet in ("top_pages", "top_countries", "top_browsers"):
+        if facet in result:
+            summary[facet] = result[facet]
+    if "unique_visitors" in result:
+        summary["unique_visitors"] = result["unique_visitors"][0]["count"] if result["unique_visitors"] else 0
+    summary["total_visits"] = result["total_visits"][0]["count"] if result["total_visits"] else 0
+    summary["recent_visits"] = [Analytics(**visit).dict() for visit in result.get("recent_visits", [])]
+    return summary
+
+# Facet counters
+# tag_counts holds one document per (facet, value) with the number of documents carrying
+# that value. The write endpoints apply the difference between a document's old and new
+# values, so tag and author listings read O(#values) documents instead of aggregating.
+def blog_facets(post: Optional[dict]) -> set:
+    if not post or not post.get("published"):
+        return set()
+    facets = {("blog_tags", tag) for tag in post.get("tags") or []}
+    if post.get("author"):
+        facets.add(("blog_authors", post["author"]))
+    return facets
+
+def gallery_facets(image: Optional[dict]) -> set:
+    return {("gallery_tags", tag) for tag in (image or {}).get("tags") or []}
+
+async def apply_facet_diff(before: set, after: set):
+    changes = [(facet, -1) for facet in before - after] + [(facet, 1) for facet in after - before]
+    if not changes:
+        return
+    await db.tag_counts.bulk_write([
+        UpdateOne({"facet": facet, "value": value}, {"$inc": {"count": delta}}, upsert=True)
+        for (facet, value), delta in changes
+    ], ordered=False)
+    if any(delta < 0 for _, delta in changes):
+        await db.tag_counts.delete_many({"facet": {"$in": list({facet for (facet, _), _ in changes})}, "count": {"$lte": 0}})
+
+async def get_facet_counts(facet: str) -> List[dict]:
+    return await db.tag_counts.find({"facet": facet}, {"_id": 0, "value": 1, "count": 1}).sort("count", -1).to_list(length=None)
+
+async def rebuild_tag_counts() -> Dict[str, int]:
+    """Recount every facet from the source collections and correct drifted counters"""
+    def distinct_per_document(collection, match: dict, field: str):
+        return collection.aggregate([
+            {"$match": match},
+            {"$project": {"values": {"$setUnion": [{"$ifNull": [f"${field}", []]}, []]}}},
+            {"$unwind": "$values"},
+            {"$group": {"_id": "$values", "count": {"$sum": 1}}}
+        ])
+    sources = {
+        "blog_tags": distinct_per_document(db.blog_posts, {"published": True}, "tags"),
+        "blog_authors": db.blog_posts.aggregate([
+            {"$match": {"published": True, "author": {"$nin": [None, ""]}}},
+            {"$group": {"_id": "$author", "count": {"$sum": 1}}}
+        ]),
+        "gallery_tags": distinct_per_document(db.gallery_images, {}, "tags")
+    }
+    corrected = 0
+    for facet, cursor in sources.items():
+        counts = {group["_id"]: group["count"] async for group in cursor}
+        if counts:
+            result = await db.tag_counts.bulk_write([
+                UpdateOne({"facet": facet, "value": value}, {"$set": {"count": count}}, upsert=True)
+                for value, count in counts.items()
+            ], ordered=False)
+            corrected += result.modified_count + result.upserted_count
+        result = await db.tag_counts.delete_many({"facet": facet, "value": {"$nin": list(counts)}})
+        corrected += result.deleted_count
+    logging.getLogger(__name__).info(f"Tag counts rebuilt, {corrected} counters corrected")
+    return {"corrected": corrected}
+
+async def init_tag_counts():
+    """Build the counters until a worker has built them once against this database"""
+    if await db.tag_counts.find_one({"_id": "meta"}, {"_id": 1}):
+        return
+    # The rebuild is idempotent, so workers starting together may both run it; the marker is
+    # only written once it succeeded, so a failed or interrupted rebuild runs again next start
+    try:
+        await rebuild_tag_counts()
+    except Exception as e:
+        logging.getLogger(__name__).error(f"Tag counts rebuild failed, retrying at next startup: {e}")
+        return
+    await db.tag_counts.update_one({"_id": "meta"}, {"$setOnInsert": {"created_at": datetime.now(timezone.utc)}}, upsert=True)
+
+# Settings cache
+async def load_settings() -> Settings:
+    doc = await db.settings.find_one() or {}
+    # Fields stored as null fall back to their defaults
+    settings = Settings(**{key: value for key, value in doc.items() if value is not None})
+    # The public payload is serialised once per settings version
+    body = json.dumps(public_settings_payload(settings), separators=(",", ":")).encode()
+    settings_cache.update({
+        "settings": settings,
+        "version": doc.get("version", 0),
+        "public_body": body,
+        "public_etag": f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+    })
+    return settings
+
+async def get_site_settings() -> Settings:
+    """Current site settings without a database round-trip"""
+    return settings_cache["settings"] or await load_settings()
+
+async def settings_poller():
+    """Pick up settings changed by other workers"""
+    while True:
+        await asyncio.sleep(SETTINGS_POLL_INTERVAL)
+        try:
+            doc = await db.settings.find_one({}, {"version": 1})
+            if doc is not None and doc.get("version", 0) != settings_cache["version"]:
+                await load_settings()
+        except Exception as e:
+            logging.getLogger(__name__).error(f"Settings refresh failed: {e}")
+
+# Index management
+# Every index the API relies on, declared per collection. ensure_indexes() creates
+# whatever is missing at startup and reports indexes nobody declared.
+REQUIRED_INDEXES = {
+    "users": [
+        {"keys": [("username", ASCENDING)], "unique": True},
+        {"keys": [("id", ASCENDING)], "unique": True},
+        {"keys": [("email", ASCENDING)]},
+    ],
+    "pages": [
+        {"keys": [("slug", ASCENDING)], "unique": True},
+        {"keys": [("id", ASCENDING)], "unique": True},
+        {"keys": [("is_homepage", ASCENDING)]},
+    ],
+    "blog_posts": [
+        {"keys": [("slug", ASCENDING)], "unique": True},
+        {"keys": [("id", ASCENDING)], "unique": True},
+        {"keys": [("published", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)]},
+        {"keys": [("created_at", DESCENDING), ("id", DESCENDING)]},
+        {"keys": [("tags", ASCENDING)]},
+        {
+            "keys": [("title", TEXT), ("excerpt", TEXT), ("content", TEXT), ("tags", TEXT)],
+            "weights": {"title": 10, "tags": 5, "excerpt": 3, "content": 1}
+        },
+    ],
+    "gallery_images": [
+        {"keys": [("id", ASCENDING)], "unique": True},
+        {"keys": [("created_at", DESCENDING), ("id", DESCENDING)]},
+        {"keys": [("tags", ASCENDING)]},
+    ],
+    "analytics": [
+        {"keys": [("timestamp", DESCENDING), ("id", DESCENDING)]},
+        {"keys": [("country", ASCENDING), ("timestamp", DESCENDING), ("id", DESCENDING)]},
+    ],
+    "analytics_rollups": [
+        {"keys": [("granularity", ASCENDING), ("bucket", DESCENDING)]},
+    ],
+    "analytics_counters": [
+        {"keys": [("granularity", ASCENDING), ("bucket", DESCENDING), ("dimension", ASCENDING), ("value", ASCENDING)], "unique": True},
+        {"keys": [("granularity", ASCENDING), ("bucket", DESCENDING), ("dimension", ASCENDING), ("count", DESCENDING)]},
+    ],
+    "blobs": [
+        {"keys": [("sha256", ASCENDING)], "unique": True},
+        {"keys": [("filename", ASCENDING)], "unique": True},
+    ],
+    "upload_sessions": [
+        {"keys": [("id", ASCENDING)], "unique": True},
+        {"keys": [("status", ASCENDING), ("updated_at", ASCENDING)]},
+    ],
+    "rate_limits": [
+        {"keys": [("expires_at", ASCENDING)], "expire_after_seconds": 0},
+    ],
+    "login_failures": [
+        {"keys": [("expires_at", ASCENDING)], "expire_after_seconds": 0},
+    ],
+    "tag_counts": [
+        {"keys": [("facet", ASCENDING), ("value", ASCENDING)], "unique": True},
+        {"keys": [("facet", ASCENDING), ("count", DESCENDING)]},
+    ],
+    "contact_messages": [
+        {"keys": [("id", ASCENDING)], "unique": True},
+        {"keys": [("created_at", DESCENDING), ("id", DESCENDING)]},
+    ],
+}
+
+def index_name(keys) -> str:
+    return "_".join(f"{field}_{direction}" for field, direction in keys)
+
+async def ensure_indexes() -> Dict[str, Dict[str, List[str]]]:
+    """Create missing indexes and report on existing ones. Safe to run repeatedly."""
+    logger = logging.getLogger(__name__)
+    report = {}
+    for collection_name, specs in REQUIRED_INDEXES.items():
+        collection = db[collection_name]
+        existing = {}
+        async for index in collection.list_indexes():
+            existing[tuple(index["key"].items())] = index
+        existing_names = {index["name"] for index in existing.values()}
+        declared = set()  # key tuples and names
+        created, failed = [], []
+        for spec in specs:
+            keys = tuple(spec["keys"])
+            name = index_name(keys)
+            declared.update({keys, name})
+            current = existing.get(keys)
+            if current is None and name in existing_names:
+                # Text indexes are listed with internal _fts/_ftsx keys, so match them by name
+                continue
+            if current is not None and bool(current.get("unique")) == bool(spec.get("unique")):
+                continue
+            options = {}
+            if "expire_after_seconds" in spec:
+                options["expireAfterSeconds"] = spec["expire_after_seconds"]
+            if "weights" in spec:
+                options["weights"] = spec["weights"]
+            try:
+                await collection.create_index(list(keys), name=name, unique=spec.get("unique", False), background=True, **options)
+                created.append(name)
+            except OperationFailure as e:
+                # Typically duplicate values blocking a unique index, or a conflicting definition
+                failed.append(name)
+                logger.error(f"Could not create index {collection_name}.{name}: {e}")
+        undeclared = [
+            index["name"] for keys, index in existing.items()
+            if index["name"] != "_id_" and keys not in declared and index["name"] not in declared
+        ]
+        # Indexes never used since the mongod started ($indexStats may be unavailable)
+        unused = []
+        try:
+            async for index_stat in collection.aggregate([{"$indexStats": {}}]):
+                if index_stat["name"] != "_id_" and index_stat.get("accesses", {}).get("ops", 0) == 0:
+                    unused.append(index_stat["name"])
+        except OperationFailure:
+            pass
+        report[collection_name] = {"created": created, "failed": failed, "undeclared": undeclared, "unused": unused}
+        if created or failed or undeclared or unused:
+            logger.info(f"Indexes on {collection_name}: created={created} failed={failed} undeclared={undeclared} unused={unused}")
+    return report
 
 # Initialize default data
 async def initialize_data():
@@ -451,12 +1845,16 @@ async def initialize_data():
             username="admin",
             email="admin@example.com",
             display_name="Site Owner",
-            password_hash=hash_password("admin"),
+            password_hash=await hash_password("admin"),
             must_change_password=True,
             is_owner=True,
             permissions=owner_permissions
         )
-        await db.users.insert_one(admin.dict())
+        await db.users.insert_one(user_document(admin))
+
+    # Convert permissions stored as nested dicts to the bitmask encoding
+    async for user in db.users.find({"permissions": {"$type": "object"}}, {"id": 1, "permissions": 1}):
+        await db.users.update_one({"id": user["id"]}, {"$set": permission_fields(decode_permissions(user))})
 
     # Create default settings if missing
     existing_settings = await db.settings.find_one()
@@ -480,26 +1878,71 @@ async def check_default_credentials():
     """Check if default admin/admin credentials are still being used"""
     try:
         user = await db.users.find_one({"username": "admin"})
-        if user and verify_password("admin", user["password_hash"]):
-            return {"has_default_credentials": True}
-        return {"has_default_credentials": False}
+        if not user:
+            return {"has_default_credentials": False}
+        # Public endpoint: only pay for the slow hash when the stored hash changes
+        password_hash = user["password_hash"]
+        if password_hash not in default_credentials_check:
+            default_credentials_check.clear()
+            default_credentials_check[password_hash] = await verify_password("admin", password_hash)
+        return {"has_default_credentials": default_credentials_check[password_hash]}
     except Exception as e:
         return {"has_default_credentials": True}  # Default to showing credentials if unsure
 
 @api_router.post("/login")
-async def login(user_data: UserLogin):
+async def login(user_data: UserLogin, request: Request):
+    client_ip = request.client.host
+    try:
+        await check_rate_limit(client_ip, "login", LOGIN_RATE_WINDOW, LOGIN_RATE_LIMIT, algorithm="token_bucket")
+    except HTTPException:
+        login_stats["rejected_rate_limited"] += 1
+        raise
+    
+    # Throttled attempts are rejected before the users collection or the password hash is touched
+    throttle_keys = [f"user:{user_data.username}", f"ip:{client_ip}"]
+    retry_after = await login_throttle.retry_after(throttle_keys)
+    if retry_after is not None:
+        login_stats["rejected_throttled"] += 1
+        wait = max(1, math.ceil(retry_after))
+        raise HTTPException(
+            status_code=429,
+            detail=f"Too many failed login attempts. Please wait {wait} seconds.",
+            headers={"Retry-After": str(wait)}
+        )
+    
+    login_stats["evaluated"] += 1
     user = await db.users.find_one({"username": user_data.username})
-    if not user or not verify_password(user_data.password, user["password_hash"]):
+    # Unknown usernames still pay for a full hash check, so response time does not reveal them
+    password_hash = user["password_hash"] if user else await get_dummy_password_hash()
+    password_ok = await verify_password(user_data.password, password_hash)
+    if not user or not password_ok:
+        login_stats["failed"] += 1
+        await login_throttle.record_failure(throttle_keys)
         raise HTTPException(status_code=401, detail="Invalid credentials")
-    token = create_token(user_data.username)
+    login_stats["succeeded"] += 1
+    await login_throttle.reset(throttle_keys[0])
+    if password_needs_rehash(user["password_hash"]):
+        await db.users.update_one(
+            {"id": user["id"], "password_hash": user["password_hash"]},
+            {"$set": {"password_hash": await hash_password(user_data.password)}}
+        )
+    token = create_token(user)
     return {"access_token": token, "token_type": "bearer", "must_change_password": user.get("must_change_password", False)}
 
+@api_router.get("/login/metrics")
+async def get_login_metrics(current_user: str = Depends(get_current_user)):
+    """Counters of evaluated vs. rejected login attempts in this process"""
+    await require_permission(current_user, "users_view")
+    return login_stats
+
+@api_router.get("/cache/metrics")
+async def get_cache_metrics(current_user: str = Depends(get_current_user)):
+    """Response cache occupancy and hit ratio in this process"""
+    await require_permission(current_user, "settings_full_admin")
+    return response_cache.metrics()
+
 @api_router.get("/me")
-async def me(current_user: str = Depends(get_current_user)):
-    user = await db.users.find_one({"username": current_user})
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-    
+async def me(current_user: str = Depends(get_current_user), user: dict = Depends(get_current_user_record)):
     # Update last login
     await db.users.update_one(
         {"username": current_user},
@@ -513,61 +1956,79 @@ async def me(current_user: str = Depends(get_current_user)):
         "display_name": user.get("display_name", ""),
         "must_change_password": user.get("must_change_password", False),
         "is_owner": user.get("is_owner", False),
-        "permissions": user.get("permissions", {}),
+        "permissions": decode_permissions(user),
         "created_at": user.get("created_at"),
         "last_login": user.get("last_login")
     }
 
 @api_router.post("/change-credentials")
-async def change_credentials(username: str = Form(...), password: str = Form(...), current_user: str = Depends(get_current_user)):
-    user = await db.users.find_one({"username": current_user})
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-    
+async def change_credentials(username: str = Form(...), password: str = Form(...), current_user: str = Depends(get_current_user), user: dict = Depends(get_current_user_record)):
     # Check if new username already exists (if different from current)
     if username != current_user:
         existing_user = await db.users.find_one({"username": username})
         if existing_user:
             raise HTTPException(status_code=400, detail="Username already exists")
     
-    # Update credentials
-    await db.users.update_one(
+    # Update credentials, revoking tokens issued for the old ones
+    updated_user = await db.users.find_one_and_update(
         {"username": current_user},
         {"$set": {
             "username": username,
-            "password_hash": hash_password(password),
+            "password_hash": await hash_password(password),
             "must_change_password": False,
             "last_login": datetime.now(timezone.utc)
-        }}
+        }, "$inc": {"token_version": 1}},
+        return_document=ReturnDocument.AFTER
     )
+    invalidate_principal(current_user, username)
     
     # Return new token with new username
-    token = create_token(username)
+    token = create_token(updated_user)
     return {"access_token": token, "token_type": "bearer", "must_change_password": False}
 
 # Permission checking utilities
+def principal_from_user(user: dict) -> Principal:
+    return Principal(
+        username=user["username"],
+        user_id=user["id"],
+        is_owner=user.get("is_owner", False),
+        is_active=user.get("is_active", True),
+        permissions=permission_mask(user)
+    )
+
+async def get_principal(username: str) -> Optional[Principal]:
+    """Cached authorization view of a user; None if the user does not exist"""
+    now = time.monotonic()
+    cached = permission_cache.get(username)
+    if cached and cached[0] > now:
+        return cached[1]
+    user = await db.users.find_one({"username": username}, {"_id": 0, "password_hash": 0})
+    principal = principal_from_user(user) if user else None
+    permission_cache.pop(username, None)
+    while len(permission_cache) >= PERMISSION_CACHE_MAX_ENTRIES:
+        permission_cache.popitem(last=False)
+    permission_cache[username] = (now + PERMISSION_CACHE_TTL, principal)
+    return principal
+
+def invalidate_principal(*usernames: str):
+    """Forget cached authorization and token versions for users whose record changed"""
+    for username in usernames:
+        permission_cache.pop(username, None)
+        token_versions.pop(username, None)
+        token_version_invalidations[username] = time.monotonic()
+
 async def check_permission(username: str, permission_path: str) -> bool:
     """Check if user has specific permission"""
-    user = await db.users.find_one({"username": username})
-    if not user or not user.get("is_active", True):
+    principal = await get_principal(username)
+    if not principal or not principal.is_active:
         return False
     
     # Owner has all permissions
-    if user.get("is_owner", False):
+    if principal.is_owner:
         return True
     
-    permissions = user.get("permissions", {})
-    
-    # Navigate nested permission path (e.g., "blog.read_all")
-    parts = permission_path.split(".")
-    current = permissions
-    for part in parts:
-        if isinstance(current, dict):
-            current = current.get(part, False)
-        else:
-            return False
-    
-    return bool(current)
+    flag = Permission.__members__.get(permission_path)
+    return flag is not None and bool(principal.permissions & flag)
 
 async def require_permission(username: str, permission: str):
     """Raise HTTP exception if user lacks permission"""
@@ -603,7 +2064,7 @@ async def get_users(current_user: str = Depends(get_current_user)):
     return {"users": users}
 
 @api_router.post("/users")
-async def create_user(user_data: UserCreate, current_user: str = Depends(get_current_user)):
+async def create_user(user_data: UserCreate, current_user: str = Depends(get_current_user), creator: dict = Depends(get_current_user_record)):
     await require_permission(current_user, "users_create")
     
     # Check if username already exists
@@ -616,22 +2077,19 @@ async def create_user(user_data: UserCreate, current_user: str = Depends(get_cur
     if existing_email:
         raise HTTPException(status_code=400, detail="Email already exists")
     
-    # Get creator info
-    creator = await db.users.find_one({"username": current_user})
-    
     # Create new user
     new_user = User(
         username=user_data.username,
         email=user_data.email,
         display_name=user_data.display_name,
-        password_hash=hash_password(user_data.password),
+        password_hash=await hash_password(user_data.password),
         must_change_password=True,
         is_owner=False,
         permissions=user_data.permissions or UserPermissions(),
-        created_by=creator["id"] if creator else None
+        created_by=creator["id"]
     )
     
-    await db.users.insert_one(new_user.dict())
+    await db.users.insert_one(user_document(new_user))
     
     return {"message": "User created successfully", "id": new_user.id}
 
@@ -645,11 +2103,13 @@ async def get_user(user_id: str, current_user: str = Depends(get_current_user)):
     
     # Remove sensitive data
     user.pop("password_hash", None)
+    user["permissions"] = decode_permissions(user)
+    user.pop("permission_pages", None)
     
     return user
 
 @api_router.put("/users/{user_id}")
-async def update_user(user_id: str, user_data: UserUpdate, current_user: str = Depends(get_current_user)):
+async def update_user(user_id: str, user_data: UserUpdate, current_user: str = Depends(get_current_user), current_user_data: dict = Depends(get_current_user_record)):
     await require_permission(current_user, "users_edit")
     
     user = await db.users.find_one({"id": user_id})
@@ -657,7 +2117,6 @@ async def update_user(user_id: str, user_data: UserUpdate, current_user: str = D
         raise HTTPException(status_code=404, detail="User not found")
     
     # Don't allow editing owner user unless you are the owner
-    current_user_data = await db.users.find_one({"username": current_user})
     if user.get("is_owner", False) and not current_user_data.get("is_owner", False):
         raise HTTPException(status_code=403, detail="Cannot edit owner user")
     
@@ -677,15 +2136,20 @@ async def update_user(user_id: str, user_data: UserUpdate, current_user: str = D
         update_data["is_active"] = user_data.is_active
     
     if user_data.permissions is not None:
-        update_data["permissions"] = user_data.permissions.dict()
+        update_data.update(permission_fields(user_data.permissions))
     
     if update_data:
-        await db.users.update_one({"id": user_id}, {"$set": update_data})
+        update = {"$set": update_data}
+        if "permissions" in update_data or "is_active" in update_data:
+            # Tokens carry a permission snapshot, so outstanding ones must be revoked
+            update["$inc"] = {"token_version": 1}
+        await db.users.update_one({"id": user_id}, update)
+        invalidate_principal(user["username"])
     
     return {"message": "User updated successfully"}
 
 @api_router.delete("/users/{user_id}")
-async def delete_user(user_id: str, current_user: str = Depends(get_current_user)):
+async def delete_user(user_id: str, current_user: str = Depends(get_current_user), current_user_data: dict = Depends(get_current_user_record)):
     await require_permission(current_user, "users_delete")
     
     user = await db.users.find_one({"id": user_id})
@@ -697,11 +2161,11 @@ async def delete_user(user_id: str, current_user: str = Depends(get_current_user
         raise HTTPException(status_code=403, detail="Cannot delete owner user")
     
     # Don't allow deleting yourself
-    current_user_data = await db.users.find_one({"username": current_user})
     if user["id"] == current_user_data["id"]:
         raise HTTPException(status_code=403, detail="Cannot delete yourself")
     
     await db.users.delete_one({"id": user_id})
+    invalidate_principal(user["username"])
     
     return {"message": "User deleted successfully"}
 
@@ -716,19 +2180,27 @@ async def reset_user_password(user_id: str, new_password: str = Form(...), curre
     await db.users.update_one(
         {"id": user_id},
         {"$set": {
-            "password_hash": hash_password(new_password),
+            "password_hash": await hash_password(new_password),
             "must_change_password": True
-        }}
+        }, "$inc": {"token_version": 1}}
     )
+    invalidate_principal(user["username"])
     
     return {"message": "Password reset successfully"}
 
+@api_router.post("/tag-counts/rebuild")
+async def rebuild_tag_counts_endpoint(current_user: str = Depends(get_current_user)):
+    """Reconcile the tag and author counters with the blog and gallery collections"""
+    await require_permission(current_user, "settings_full_admin")
+    result = await rebuild_tag_counts()
+    response_cache.invalidate("blog_lists")
+    return result
+
 # Backup and Restore endpoints
 @api_router.post("/backup")
-async def create_backup(current_user: str = Depends(get_current_user)):
+async def create_backup(current_user: str = Depends(get_current_user), user: dict = Depends(get_current_user_record)):
     # Only owners can create backups
-    user = await db.users.find_one({"username": current_user})
-    if not user or not user.get("is_owner", False):
+    if not user.get("is_owner", False):
         raise HTTPException(status_code=403, detail="Only site owner can create backups")
     
     import json
@@ -745,7 +2217,7 @@ async def create_backup(current_user: str = Depends(get_current_user)):
     
     try:
         # Backup collections
-        collections = ["users", "pages", "blog_posts", "settings", "analytics", "contact_messages"]
+        collections = ["users", "pages", "blog_posts", "settings", "analytics", "contact_messages", "blobs"]
         backup_data = {
             "metadata": {
                 "backup_id": backup_id,
@@ -774,7 +2246,8 @@ async def create_backup(current_user: str = Depends(get_current_user)):
         # Backup uploaded files
         uploads_dir = Path("/app/uploads")
         if uploads_dir.exists():
-            shutil.copytree(uploads_dir, backup_dir / "uploads", dirs_exist_ok=True)
+            # Dot entries are in-flight temp files and multi-part session parts
+            shutil.copytree(uploads_dir, backup_dir / "uploads", ignore=shutil.ignore_patterns(".*"), dirs_exist_ok=True)
         
         # Create backup info file
         info = {
@@ -802,10 +2275,9 @@ async def create_backup(current_user: str = Depends(get_current_user)):
         raise HTTPException(status_code=500, detail=f"Backup failed: {str(e)}")
 
 @api_router.get("/backups")
-async def list_backups(current_user: str = Depends(get_current_user)):
+async def list_backups(current_user: str = Depends(get_current_user), user: dict = Depends(get_current_user_record)):
     # Only owners can list backups
-    user = await db.users.find_one({"username": current_user})
-    if not user or not user.get("is_owner", False):
+    if not user.get("is_owner", False):
         raise HTTPException(status_code=403, detail="Only site owner can access backups")
     
     import json
@@ -839,10 +2311,9 @@ async def list_backups(current_user: str = Depends(get_current_user)):
     return {"backups": backups}
 
 @api_router.post("/restore/{backup_name}")
-async def restore_backup(backup_name: str, current_user: str = Depends(get_current_user)):
+async def restore_backup(backup_name: str, current_user: str = Depends(get_current_user), user: dict = Depends(get_current_user_record)):
     # Only owners can restore backups
-    user = await db.users.find_one({"username": current_user})
-    if not user or not user.get("is_owner", False):
+    if not user.get("is_owner", False):
         raise HTTPException(status_code=403, detail="Only site owner can restore backups")
     
     import json
@@ -876,7 +2347,7 @@ async def restore_backup(backup_name: str, current_user: str = Depends(get_curre
             # Convert datetime strings back to datetime objects
             for item in items:
                 for key, value in item.items():
-                    if isinstance(value, str) and key.endswith(('_at', 'last_login')) and 'T' in value:
+                    if isinstance(value, str) and (key.endswith(('_at', 'last_login')) or key == 'timestamp') and 'T' in value:
                         try:
                             # Parse ISO format datetime
                             item[key] = datetime.fromisoformat(value.replace('Z', '+00:00'))
@@ -888,17 +2359,37 @@ async def restore_backup(backup_name: str, current_user: str = Depends(get_curre
                 await collection.insert_many(items)
                 collections_restored += 1
         
+        # Restored users may have different permissions
+        permission_cache.clear()
+        count_cache.clear()
+        response_cache.clear()
+        await bump_content_version()
+        await refresh_token_versions()
+        await db.settings.update_one({}, {"$inc": {"version": 1}})
+        await load_settings()
+        
+        # Raw visits changed underneath the rollups, rebuild them
+        if backup_data["data"].get("analytics"):
+            await reset_analytics_rollups()
+        await rebuild_tag_counts()
+        
         # Restore uploaded files
         uploads_backup = backup_dir / "uploads"
         uploads_dir = Path("/app/uploads")
         
         if uploads_backup.exists():
-            # Remove existing uploads
+            # Remove existing uploads, leaving in-flight temp files and multi-part parts alone
             if uploads_dir.exists():
-                shutil.rmtree(uploads_dir)
+                for entry in uploads_dir.iterdir():
+                    if entry.name.startswith("."):
+                        continue
+                    if entry.is_dir():
+                        shutil.rmtree(entry)
+                    else:
+                        entry.unlink()
             
             # Copy backup uploads
-            shutil.copytree(uploads_backup, uploads_dir)
+            shutil.copytree(uploads_backup, uploads_dir, ignore=shutil.ignore_patterns(".*"), dirs_exist_ok=True)
         
         return {
             "message": "Backup restored successfully",
@@ -910,10 +2401,9 @@ async def restore_backup(backup_name: str, current_user: str = Depends(get_curre
         raise HTTPException(status_code=500, detail=f"Restore failed: {str(e)}")
 
 @api_router.delete("/backups/{backup_name}")
-async def delete_backup(backup_name: str, current_user: str = Depends(get_current_user)):
+async def delete_backup(backup_name: str, current_user: str = Depends(get_current_user), user: dict = Depends(get_current_user_record)):
     # Only owners can delete backups
-    user = await db.users.find_one({"username": current_user})
-    if not user or not user.get("is_owner", False):
+    if not user.get("is_owner", False):
         raise HTTPException(status_code=403, detail="Only site owner can delete backups")
     
     import shutil
@@ -934,31 +2424,35 @@ async def change_credentials(
     old_password: str = Form(...),
     new_username: str = Form(...),
     new_password: str = Form(...),
-    current_user: str = Depends(get_current_user)
+    current_user: str = Depends(get_current_user),
+    user: dict = Depends(get_current_user_record)
 ):
-    user = await db.users.find_one({"username": current_user})
-    if not user or not verify_password(old_password, user["password_hash"]):
+    if not await verify_password(old_password, user["password_hash"]):
         raise HTTPException(status_code=400, detail="Invalid old password")
     # prevent duplicate username
     if await db.users.find_one({"username": new_username}):
         raise HTTPException(status_code=400, detail="Username already exists")
     await db.users.update_one(
         {"username": current_user},
-        {"$set": {"username": new_username, "password_hash": hash_password(new_password), "must_change_password": False}}
+        {"$set": {"username": new_username, "password_hash": await hash_password(new_password), "must_change_password": False},
+         "$inc": {"token_version": 1}}
     )
+    invalidate_principal(current_user, new_username)
     return {"message": "Credentials updated successfully"}
 
 # Page endpoints
 @api_router.get("/page/{slug}")
 async def get_page(slug: str, request: Request):
     await track_visit(request, f"/page/{slug}")
-    if slug == "home":
-        page = await db.pages.find_one({"is_homepage": True})
-    else:
-        page = await db.pages.find_one({"slug": slug})
-    if not page:
-        raise HTTPException(status_code=404, detail="Page not found")
-    return Page(**page)
+    async def build():
+        if slug == "home":
+            page = await db.pages.find_one({"is_homepage": True})
+        else:
+            page = await db.pages.find_one({"slug": slug})
+        if not page:
+            raise HTTPException(status_code=404, detail="Page not found")
+        return Page(**page), [f"page:{page['id']}"], None
+    return await cached_json_response(request, build)
 
 @api_router.get("/pages", response_model=List[Page])
 async def get_all_pages(current_user: str = Depends(get_current_user)):
@@ -972,6 +2466,8 @@ async def create_page(page_data: PageCreate, current_user: str = Depends(get_cur
         raise HTTPException(status_code=400, detail="Page with this slug already exists")
     page = Page(title=page_data.title, slug=page_data.slug, content=page_data.content)
     await db.pages.insert_one(page.dict())
+    # Only found pages are cached, so nothing is stale yet
+    await bump_content_version()
     return page
 
 @api_router.put("/pages/{page_id}")
@@ -984,6 +2480,8 @@ async def update_page(page_id: str, page_data: PageUpdate, current_user: str = D
     result = await db.pages.update_one({"id": page_id}, {"$set": update_data})
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Page not found")
+    response_cache.invalidate(f"page:{page_id}")
+    await bump_content_version()
     return {"message": "Page updated successfully"}
 
 @api_router.delete("/pages/{page_id}")
@@ -994,6 +2492,8 @@ async def delete_page(page_id: str, current_user: str = Depends(get_current_user
     result = await db.pages.delete_one({"id": page_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Page not found")
+    response_cache.invalidate(f"page:{page_id}")
+    await bump_content_version()
     return {"message": "Page deleted successfully"}
 
 # Blog endpoints
@@ -1004,7 +2504,9 @@ async def get_blog_posts(
     limit: int = 10,
     tag: Optional[str] = None,
     author: Optional[str] = None,
-    published_only: bool = True
+    published_only: bool = True,
+    pagination: str = "offset",
+    cursor: Optional[str] = None
 ):
     await track_visit(request, "/blog")
     query = {}
@@ -1015,20 +2517,38 @@ async def get_blog_posts(
     if author:
         query["author"] = {"$regex": author, "$options": "i"}
     
-    skip = (page - 1) * limit
-    posts = await db.blog_posts.find(query).sort("created_at", -1).skip(skip).limit(limit).to_list(length=limit)
-    return [BlogPost(**post) for post in posts]
+    async def build():
+        if use_cursor_pagination(pagination, cursor):
+            posts, next_cursor, prev_cursor = await keyset_page(db.blog_posts, query, "created_at", cursor, limit)
+            # The body stays a plain list, so cursors travel in a Link header
+            links = [f'<{request.url.include_query_params(cursor=value)}>; rel="{rel}"'
+                     for rel, value in (("next", next_cursor), ("prev", prev_cursor)) if value]
+            return [BlogPost(**post) for post in posts], ["blog_lists"], {"link": ", ".join(links)} if links else None
+        skip = (page - 1) * limit
+        posts = await db.blog_posts.find(query).sort([("created_at", -1), ("id", -1)]).skip(skip).limit(limit).to_list(length=limit)
+        return [BlogPost(**post) for post in posts], ["blog_lists"], None
+    return await cached_json_response(request, build)
 
 @api_router.post("/blog/search")
 async def search_blog_posts(search_request: BlogSearchRequest):
     query = await build_blog_search_query(search_request)
     
     # Get total count
-    total = await db.blog_posts.count_documents(query)
+    total = await count_matches(db.blog_posts, query, count_strategy("blog_search", search_request.count))
     
     # Get paginated results
     skip = (search_request.page - 1) * search_request.limit
-    posts = await db.blog_posts.find(query).sort("created_at", -1).skip(skip).limit(search_request.limit).to_list(length=search_request.limit)
+    cursor_mode = use_cursor_pagination(search_request.pagination, search_request.cursor)
+    if cursor_mode:
+        # Relevance order has no stable key to seek on, so cursor pages run newest first
+        posts, next_cursor, prev_cursor = await keyset_page(db.blog_posts, query, "created_at", search_request.cursor, search_request.limit)
+    elif search_request.query:
+        # Most relevant first
+        cursor = db.blog_posts.find(query, {"score": {"$meta": "textScore"}}).sort([("score", {"$meta": "textScore"}), ("created_at", -1)])
+    else:
+        cursor = db.blog_posts.find(query).sort([("created_at", -1), ("id", -1)])
+    if not cursor_mode:
+        posts, has_next = await fetch_offset_page(cursor, skip, search_request.limit, total)
     
     # Process results with highlighting
     results = []
@@ -1039,6 +2559,18 @@ async def search_blog_posts(search_request: BlogSearchRequest):
             blog_post.excerpt = highlight_search_terms(blog_post.excerpt or "", search_request.query)
         results.append(blog_post)
     
+    if cursor_mode:
+        return {"posts": results, "pagination": cursor_pagination(search_request.limit, next_cursor, prev_cursor, total)}
+    if total is None:
+        return {
+            "posts": results,
+            "pagination": {
+                "current_page": search_request.page,
+                "per_page": search_request.limit,
+                "has_next": has_next,
+                "has_prev": search_request.page > 1
+            }
+        }
     return {
         "posts": results,
         "pagination": {
@@ -1050,34 +2582,33 @@ async def search_blog_posts(search_request: BlogSearchRequest):
     }
 
 @api_router.get("/blog/tags")
-async def get_blog_tags():
+async def get_blog_tags(request: Request):
     """Get all unique tags from blog posts"""
-    pipeline = [
-        {"$match": {"published": True}},
-        {"$unwind": "$tags"},
-        {"$group": {"_id": "$tags", "count": {"$sum": 1}}},
-        {"$sort": {"count": -1}},
-        {"$project": {"tag": "$_id", "count": 1, "_id": 0}}
-    ]
-    tags = await db.blog_posts.aggregate(pipeline).to_list(length=None)
-    return tags
+    async def build():
+        tags = [{"tag": entry["value"], "count": entry["count"]} for entry in await get_facet_counts("blog_tags")]
+        return tags, ["blog_lists"], None
+    return await cached_json_response(request, build)
 
 @api_router.get("/blog/authors")
-async def get_blog_authors():
+async def get_blog_authors(request: Request):
     """Get all unique authors from blog posts"""
-    authors = await db.blog_posts.distinct("author", {"published": True})
-    return authors
+    async def build():
+        authors = sorted(entry["value"] for entry in await get_facet_counts("blog_authors"))
+        return authors, ["blog_lists"], None
+    return await cached_json_response(request, build)
 
 @api_router.get("/blog/{slug}")
 async def get_blog_post(slug: str, request: Request):
     await track_visit(request, f"/blog/{slug}")
-    post = await db.blog_posts.find_one({"slug": slug})
-    if not post:
-        raise HTTPException(status_code=404, detail="Blog post not found")
-    return BlogPost(**post)
+    async def build():
+        post = await db.blog_posts.find_one({"slug": slug})
+        if not post:
+            raise HTTPException(status_code=404, detail="Blog post not found")
+        return BlogPost(**post), [f"blog:{post['id']}"], None
+    return await cached_json_response(request, build)
 
 @api_router.post("/blog", response_model=BlogPost)
-async def create_blog_post(post_data: BlogPostCreate, current_user: str = Depends(get_current_user)):
+async def create_blog_post(post_data: BlogPostCreate, current_user: str = Depends(get_current_user), user: dict = Depends(get_current_user_record)):
     await require_permission(current_user, "blog_write_new")
     
     existing = await db.blog_posts.find_one({"slug": post_data.slug})
@@ -1087,13 +2618,10 @@ async def create_blog_post(post_data: BlogPostCreate, current_user: str = Depend
     # Auto-generate excerpt if not provided
     excerpt = post_data.excerpt
     if not excerpt:
-        settings = await db.settings.find_one() or {}
-        excerpt_length = settings.get("auto_excerpt_length", 200)
+        settings = await get_site_settings()
+        excerpt_length = settings.auto_excerpt_length
         excerpt = extract_excerpt(post_data.content, excerpt_length)
     
-    # Get current user for author info
-    user = await db.users.find_one({"username": current_user})
-    
     post = BlogPost(
         title=post_data.title,
         slug=post_data.slug,
@@ -1105,17 +2633,20 @@ async def create_blog_post(post_data: BlogPostCreate, current_user: str = Depend
         published=post_data.published
     )
     await db.blog_posts.insert_one(post.dict())
+    await apply_facet_diff(set(), blog_facets(post.dict()))
+    invalidate_counts("blog_posts")
+    response_cache.invalidate("blog_lists")
+    await bump_content_version()
     return post
 
 @api_router.put("/blog/{post_id}")
-async def update_blog_post(post_id: str, post_data: BlogPostUpdate, current_user: str = Depends(get_current_user)):
+async def update_blog_post(post_id: str, post_data: BlogPostUpdate, current_user: str = Depends(get_current_user), user: dict = Depends(get_current_user_record)):
     # Check permission - can edit all posts or can edit own posts
     post = await db.blog_posts.find_one({"id": post_id})
     if not post:
         raise HTTPException(status_code=404, detail="Blog post not found")
     
     # Get current user info
-    user = await db.users.find_one({"username": current_user})
     user_display_name = user.get("display_name", current_user)
     
     # Check permissions
@@ -1134,8 +2665,8 @@ async def update_blog_post(post_id: str, post_data: BlogPostUpdate, current_user
     # Auto-generate excerpt if not provided
     excerpt = post_data.excerpt
     if not excerpt:
-        settings = await db.settings.find_one() or {}
-        excerpt_length = settings.get("auto_excerpt_length", 200)
+        settings = await get_site_settings()
+        excerpt_length = settings.auto_excerpt_length
         excerpt = extract_excerpt(post_data.content, excerpt_length)
     
     update_data = {
@@ -1148,41 +2679,512 @@ async def update_blog_post(post_id: str, post_data: BlogPostUpdate, current_user
         "published": post_data.published,
         "updated_at": datetime.now(timezone.utc)
     }
-    result = await db.blog_posts.update_one({"id": post_id}, {"$set": update_data})
-    if result.matched_count == 0:
+    # The pre-image gives the exact tag diff for the counters
+    before = await db.blog_posts.find_one_and_update({"id": post_id}, {"$set": update_data}, return_document=ReturnDocument.BEFORE)
+    if before is None:
         raise HTTPException(status_code=404, detail="Blog post not found")
+    await apply_facet_diff(blog_facets(before), blog_facets({**before, **update_data}))
+    invalidate_counts("blog_posts")
+    response_cache.invalidate("blog_lists", f"blog:{post_id}")
+    await bump_content_version()
     return {"message": "Blog post updated successfully"}
 
 @api_router.delete("/blog/{post_id}")
 async def delete_blog_post(post_id: str, current_user: str = Depends(get_current_user)):
     await require_permission(current_user, "blog_delete_posts")
     
-    result = await db.blog_posts.delete_one({"id": post_id})
-    if result.deleted_count == 0:
+    post = await db.blog_posts.find_one_and_delete({"id": post_id})
+    if post is None:
         raise HTTPException(status_code=404, detail="Blog post not found")
+    await apply_facet_diff(blog_facets(post), set())
+    invalidate_counts("blog_posts")
+    response_cache.invalidate("blog_lists", f"blog:{post_id}")
+    await bump_content_version()
     return {"message": "Blog post deleted successfully"}
 
+# Content-addressed blob store: uploads are named by their SHA-256 and reference counted
+def blob_filename(sha256: str, original_name: str) -> str:
+    file_extension = original_name.split('.')[-1].lower() if '.' in original_name else ''
+    return f"{sha256}.{file_extension}" if file_extension else sha256
+
+async def store_blob(temp_path: Path, sha256: str, size: int, original_name: str) -> str:
+    """Move a fully written temp file into the blob store"""
+    blob = await db.blobs.find_one_and_update(
+        {"sha256": sha256},
+        {
+            "$inc": {"refcount": 1},
+            "$setOnInsert": {"filename": blob_filename(sha256, original_name), "size": size, "created_at": datetime.now(timezone.utc)}
+        },
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    # Always replace: the content is identical, and a release_blob racing with the upsert
+    # may have just removed the existing file
+    try:
+        os.replace(temp_path, UPLOAD_DIR / blob["filename"])
+    except BaseException:
+        await release_blob(blob["filename"])
+        raise
+    return blob["filename"]
+
+async def release_blob(filename: str):
+    """Drop one reference to a stored file, deleting it once nothing refers to it"""
+    blob = await db.blobs.find_one_and_update(
+        {"filename": filename},
+        {"$inc": {"refcount": -1}},
+        return_document=ReturnDocument.AFTER
+    )
+    if blob is None:
+        # Uploaded before the blob store existed; the file is not shared
+        remove_upload(filename)
+        return
+    if blob["refcount"] <= 0:
+        result = await db.blobs.delete_one({"filename": filename, "refcount": {"$lte": 0}})
+        if result.deleted_count:
+            await discard_blob_file(filename)
+
+async def discard_blob_file(filename: str):
+    """Delete an unreferenced blob's file unless a concurrent store_blob has claimed it again"""
+    path = UPLOAD_DIR / filename
+    # Move the file aside first so a re-upserted blob can get it back
+    tombstone = UPLOAD_DIR / f".{filename}.{uuid.uuid4()}.deleted"
+    try:
+        os.replace(path, tombstone)
+    except FileNotFoundError:
+        tombstone = None
+    if await db.blobs.find_one({"filename": filename}, {"_id": 1}):
+        # store_blob writes its own copy after upserting, but it may already have done so
+        if tombstone is not None:
+            os.replace(tombstone, path)
+        return
+    if tombstone is not None:
+        tombstone.unlink(missing_ok=True)
+    remove_upload(filename)
+
+def remove_upload(filename: str):
+    """Delete a stored file together with any derivatives generated from it"""
+    (UPLOAD_DIR / filename).unlink(missing_ok=True)
+    stem = filename.split(".")[0]
+    for derivative in UPLOAD_DIR.glob(f"{stem}_*w.*"):
+        derivative.unlink(missing_ok=True)
+
+async def store_upload(file: UploadFile, max_size: int) -> Dict:
+    """Copy a spooled upload to disk in fixed-size chunks, enforcing max_size, and add it to the blob store.
+    
+    Oversized request bodies are refused earlier by UploadSizeLimitMiddleware."""
+    if file.size is not None and file.size > max_size:
+        raise HTTPException(status_code=413, detail="File too large")
+    # Write inside UPLOAD_DIR so the final rename is atomic
+    temp_path = UPLOAD_DIR / f".{uuid.uuid4()}.part"
+    hasher = hashlib.sha256()
+    size = 0
+    try:
+        async with aiofiles.open(temp_path, 'wb') as f:
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                size += len(chunk)
+                if size > max_size:
+                    raise HTTPException(status_code=413, detail="File too large")
+                hasher.update(chunk)
+                await f.write(chunk)
+        sha256 = hasher.hexdigest()
+        filename = await store_blob(temp_path, sha256, size, file.filename)
+    except BaseException:
+        temp_path.unlink(missing_ok=True)
+        raise
+    return {"filename": filename, "size": size, "sha256": sha256}
+
 # File upload endpoints
 @api_router.post("/upload")
 async def upload_file(file: UploadFile = File(...), current_user: str = Depends(get_current_user)):
-    settings = await db.settings.find_one()
-    max_size = settings["max_file_size"] if settings else 5368709120
-    file_extension = file.filename.split('.')[-1] if '.' in file.filename else ''
-    unique_filename = f"{uuid.uuid4()}.{file_extension}" if file_extension else str(uuid.uuid4())
-    file_path = UPLOAD_DIR / unique_filename
-    async with aiofiles.open(file_path, 'wb') as f:
-        content = await file.read()
-        if len(content) > max_size:
-            raise HTTPException(status_code=413, detail="File too large")
-        await f.write(content)
-    return {"filename": unique_filename, "original_name": file.filename, "size": len(content)}
+    max_size = (await get_site_settings()).max_file_size
+    stored = await store_upload(file, max_size)
+    return {"filename": stored["filename"], "original_name": file.filename, "size": stored["size"], "sha256": stored["sha256"]}
+
+# Resumable multi-part uploads
+async def get_upload_session(upload_id: str, username: str) -> dict:
+    session = await db.upload_sessions.find_one({"id": upload_id})
+    if not session or session["created_by"] != username:
+        raise HTTPException(status_code=404, detail="Upload session not found")
+    if session["status"] != "active":
+        raise HTTPException(status_code=409, detail=f"Upload session is {session['status']}")
+    return session
+
+def concatenate_parts(part_paths: List[Path], destination: Path) -> str:
+    """Join part files into destination chunk by chunk, returning the SHA-256 of the result"""
+    hasher = hashlib.sha256()
+    with open(destination, 'wb') as out:
+        for part_path in part_paths:
+            with open(part_path, 'rb') as part:
+                while chunk := part.read(UPLOAD_CHUNK_SIZE):
+                    hasher.update(chunk)
+                    out.write(chunk)
+    return hasher.hexdigest()
+
+def remove_upload_parts(upload_id: str):
+    import shutil
+    shutil.rmtree(UPLOAD_PARTS_DIR / upload_id, ignore_errors=True)
+
+@api_router.post("/uploads/multipart")
+async def initiate_multipart_upload(session_data: UploadSessionCreate, current_user: str = Depends(get_current_user)):
+    max_size = (await get_site_settings()).max_file_size
+    if session_data.total_size is not None and session_data.total_size > max_size:
+        raise HTTPException(status_code=413, detail="File too large")
+    session = UploadSession(filename=session_data.filename, total_size=session_data.total_size, created_by=current_user)
+    (UPLOAD_PARTS_DIR / session.id).mkdir()
+    await db.upload_sessions.insert_one(session.dict())
+    return {"upload_id": session.id, "max_parts": UPLOAD_MAX_PARTS, "expires_in": UPLOAD_SESSION_TTL}
+
+@api_router.get("/uploads/multipart/{upload_id}")
+async def get_multipart_upload(upload_id: str, current_user: str = Depends(get_current_user)):
+    session = await db.upload_sessions.find_one({"id": upload_id, "created_by": current_user})
+    if not session:
+        raise HTTPException(status_code=404, detail="Upload session not found")
+    return UploadSession(**session)
+
+@api_router.put("/uploads/multipart/{upload_id}/parts/{part_number}")
+async def upload_part(upload_id: str, part_number: int, request: Request, current_user: str = Depends(get_current_user)):
+    """Store one part from the raw request body; parts may be sent in parallel and retried"""
+    if not 1 <= part_number <= UPLOAD_MAX_PARTS:
+        raise HTTPException(status_code=400, detail=f"Part number must be between 1 and {UPLOAD_MAX_PARTS}")
+    session = await get_upload_session(upload_id, current_user)
+    max_size = (await get_site_settings()).max_file_size
+    # Bytes already accounted for by other parts; a retried part replaces its previous size
+    remaining = max_size - sum(part["size"] for number, part in session["parts"].items() if number != str(part_number))
+    
+    part_path = UPLOAD_PARTS_DIR / upload_id / f"{part_number:05d}.part"
+    temp_path = part_path.with_suffix(f".{uuid.uuid4()}.tmp")
+    hasher = hashlib.sha256()
+    size = 0
+    try:
+        async with aiofiles.open(temp_path, 'wb') as f:
+            async for chunk in request.stream():
+                size += len(chunk)
+                if size > remaining:
+                    raise HTTPException(status_code=413, detail="File too large")
+                hasher.update(chunk)
+                await f.write(chunk)
+        os.replace(temp_path, part_path)
+    except BaseException:
+        temp_path.unlink(missing_ok=True)
+        raise
+    
+    part_info = {"size": size, "sha256": hasher.hexdigest()}
+    await db.upload_sessions.update_one(
+        {"id": upload_id},
+        {"$set": {f"parts.{part_number}": part_info, "updated_at": datetime.now(timezone.utc)}}
+    )
+    return {"part_number": part_number, **part_info}
+
+@api_router.post("/uploads/multipart/{upload_id}/complete")
+async def complete_multipart_upload(upload_id: str, current_user: str = Depends(get_current_user)):
+    session = await get_upload_session(upload_id, current_user)
+    part_numbers = sorted(int(number) for number in session["parts"])
+    if not part_numbers or part_numbers != list(range(1, len(part_numbers) + 1)):
+        raise HTTPException(status_code=400, detail="Parts must be numbered consecutively from 1")
+    total_size = sum(part["size"] for part in session["parts"].values())
+    if session.get("total_size") is not None and total_size != session["total_size"]:
+        raise HTTPException(status_code=400, detail=f"Expected {session['total_size']} bytes, received {total_size}")
+    # Parts uploaded in parallel each passed their own remaining-size check, so check the sum
+    if total_size > (await get_site_settings()).max_file_size:
+        raise HTTPException(status_code=413, detail="File too large")
+    
+    # Claim the session so concurrent complete/abort calls cannot race; if this process dies
+    # before finishing, the GC finds the claim by its updated_at and removes temp_filename
+    temp_path = UPLOAD_DIR / f".{uuid.uuid4()}.part"
+    claimed = await db.upload_sessions.update_one(
+        {"id": upload_id, "status": "active"},
+        {"$set": {"status": "completing", "temp_filename": temp_path.name, "updated_at": datetime.now(timezone.utc)}}
+    )
+    if claimed.modified_count == 0:
+        raise HTTPException(status_code=409, detail="Upload session is no longer active")
+    
+    part_paths = [UPLOAD_PARTS_DIR / upload_id / f"{number:05d}.part" for number in part_numbers]
+    try:
+        sha256 = await asyncio.to_thread(concatenate_parts, part_paths, temp_path)
+        unique_filename = await store_blob(temp_path, sha256, total_size, session["filename"])
+    except Exception:
+        temp_path.unlink(missing_ok=True)
+        await db.upload_sessions.update_one({"id": upload_id}, {"$set": {"status": "active"}})
+        raise
+    
+    remove_upload_parts(upload_id)
+    try:
+        await db.upload_sessions.update_one(
+            {"id": upload_id},
+            {"$set": {"status": "completed", "result_filename": unique_filename, "updated_at": datetime.now(timezone.utc)}}
+        )
+    except BaseException:
+        # The client never learns the filename, so nothing will ever release it
+        await release_blob(unique_filename)
+        raise
+    return {"filename": unique_filename, "original_name": session["filename"], "size": total_size, "sha256": sha256}
+
+@api_router.delete("/uploads/multipart/{upload_id}")
+async def abort_multipart_upload(upload_id: str, current_user: str = Depends(get_current_user)):
+    await get_upload_session(upload_id, current_user)
+    await db.upload_sessions.update_one(
+        {"id": upload_id},
+        {"$set": {"status": "aborted", "parts": {}, "updated_at": datetime.now(timezone.utc)}}
+    )
+    remove_upload_parts(upload_id)
+    return {"message": "Upload aborted"}
+
+async def expire_upload_sessions():
+    """Remove parts of sessions that have not seen activity within UPLOAD_SESSION_TTL"""
+    cutoff = datetime.now(timezone.utc) - timedelta(seconds=UPLOAD_SESSION_TTL)
+    expired = 0
+    # A session still "completing" this long after its claim belongs to a process that died
+    unfinished = {"$in": ["active", "completing"]}
+    async for session in db.upload_sessions.find({"status": unfinished, "updated_at": {"$lt": cutoff}}, {"id": 1, "temp_filename": 1}):
+        result = await db.upload_sessions.update_one(
+            {"id": session["id"], "status": unfinished, "updated_at": {"$lt": cutoff}},
+            {"$set": {"status": "expired", "parts": {}}}
+        )
+        if result.modified_count:
+            remove_upload_parts(session["id"])
+            if session.get("temp_filename"):
+                (UPLOAD_DIR / session["temp_filename"]).unlink(missing_ok=True)
+            expired += 1
+    # Finished sessions are only kept around for a while for clients polling their status
+    finished = {"status": {"$nin": ["active", "completing"]}, "updated_at": {"$lt": cutoff}}
+    async for session in db.upload_sessions.find(finished, {"id": 1}):
+        remove_upload_parts(session["id"])
+    await db.upload_sessions.delete_many(finished)
+    if expired:
+        logging.getLogger(__name__).info(f"Expired {expired} abandoned upload sessions")
+
+async def upload_session_gc():
+    while True:
+        try:
+            await expire_upload_sessions()
+        except Exception as e:
+            logging.getLogger(__name__).error(f"Upload session cleanup failed: {e}")
+        await asyncio.sleep(min(UPLOAD_SESSION_TTL, 3600))
+
+# Static serving of uploads: caching headers, conditional GET and byte ranges
+def upload_cache_headers(filename: str, file_stat: os.stat_result) -> Dict[str, str]:
+    if CONTENT_ADDRESSED_NAME.match(filename):
+        # The name is the content hash, so it can never change
+        etag = f'"{filename.split(".")[0]}"'
+        cache_control = "public, max-age=31536000, immutable"
+    else:
+        etag = f'"{file_stat.st_mtime_ns:x}-{file_stat.st_size:x}"'
+        cache_control = f"public, max-age={UPLOAD_CACHE_MAX_AGE}"
+    return {
+        "etag": etag,
+        "last-modified": formatdate(file_stat.st_mtime, usegmt=True),
+        "cache-control": cache_control
+    }
+
+def etag_matches(header_value: str, etag: str) -> bool:
+    candidates = [candidate.strip() for candidate in header_value.split(",")]
+    return "*" in candidates or any(candidate.removeprefix("W/") == etag for candidate in candidates)
+
+def modified_since(header_value: str, file_stat: os.stat_result) -> bool:
+    try:
+        return int(file_stat.st_mtime) > parsedate_to_datetime(header_value).timestamp()
+    except (TypeError, ValueError):
+        return True
+
+def is_not_modified(request: Request, headers: Dict[str, str], file_stat: os.stat_result) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        return etag_matches(if_none_match, headers["etag"])
+    if_modified_since = request.headers.get("if-modified-since")
+    return if_modified_since is not None and not modified_since(if_modified_since, file_stat)
+
+def if_range_allows(request: Request, headers: Dict[str, str], file_stat: os.stat_result) -> bool:
+    """A Range request is only honoured if its If-Range validator still matches"""
+    if_range = request.headers.get("if-range")
+    if if_range is None:
+        return True
+    if if_range.startswith('"') or if_range.startswith("W/"):
+        return if_range == headers["etag"]
+    return not modified_since(if_range, file_stat)
+
+def parse_range_header(range_header: str, file_size: int) -> Optional[List[tuple]]:
+    """Inclusive (start, end) byte ranges; [] if none is satisfiable, None if the header should be ignored"""
+    unit, _, spec = range_header.partition("=")
+    if unit.strip().lower() != "bytes" or not spec.strip():
+        return None
+    ranges = []
+    for part in spec.split(","):
+        first, separator, last = part.strip().partition("-")
+        if not separator:
+            return None
+        try:
+            if first == "":
+                length = int(last)
+                if length == 0:
+                    continue
+                start, end = max(file_size - length, 0), file_size - 1
+            else:
+                start = int(first)
+                end = min(int(last), file_size - 1) if last else file_size - 1
+                if start > int(last or start):
+                    return None
+        except ValueError:
+            return None
+        if start < file_size:
+            ranges.append((start, end))
+    # Coalesce overlapping or adjacent ranges
+    ranges.sort()
+    merged = []
+    for start, end in ranges:
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    if len(merged) > UPLOAD_MAX_RANGES:
+        return None
+    return merged
+
+async def iter_file_range(file_path: Path, start: int, end: int):
+    async with aiofiles.open(file_path, 'rb') as f:
+        await f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = await f.read(min(UPLOAD_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+def range_response(file_path: Path, ranges: List[tuple], file_size: int, media_type: str, headers: Dict[str, str]) -> Response:
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        headers = {**headers, "content-range": f"bytes {start}-{end}/{file_size}", "content-length": str(end - start + 1)}
+        return StreamingResponse(iter_file_range(file_path, start, end), status_code=206, media_type=media_type, headers=headers)
+    
+    boundary = uuid.uuid4().hex
+    part_headers = [
+        f"--{boundary}\r\nContent-Type: {media_type}\r\nContent-Range: bytes {start}-{end}/{file_size}\r\n\r\n".encode()
+        for start, end in ranges
+    ]
+    closing = f"--{boundary}--\r\n".encode()
+    content_length = sum(len(part) + (end - start + 1) + 2 for part, (start, end) in zip(part_headers, ranges)) + len(closing)
+    
+    async def body():
+        for part, (start, end) in zip(part_headers, ranges):
+            yield part
+            async for chunk in iter_file_range(file_path, start, end):
+                yield chunk
+            yield b"\r\n"
+        yield closing
+    
+    headers = {**headers, "content-length": str(content_length)}
+    return StreamingResponse(body(), status_code=206, media_type=f"multipart/byteranges; boundary={boundary}", headers=headers)
 
 @api_router.get("/uploads/{filename}")
-async def get_uploaded_file(filename: str):
+async def get_uploaded_file(filename: str, request: Request):
+    # Hidden entries are in-progress uploads and multi-part sessions
+    if filename.startswith(".") or Path(filename).name != filename:
+        raise HTTPException(status_code=404, detail="File not found")
     file_path = UPLOAD_DIR / filename
-    if not file_path.exists():
+    try:
+        file_stat = file_path.stat()
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="File not found")
+    if not stat.S_ISREG(file_stat.st_mode):
         raise HTTPException(status_code=404, detail="File not found")
-    return FileResponse(file_path)
+    
+    headers = upload_cache_headers(filename, file_stat)
+    if is_not_modified(request, headers, file_stat):
+        return Response(status_code=304, headers=headers)
+    
+    headers["accept-ranges"] = "bytes"
+    media_type = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    range_header = request.headers.get("range")
+    if range_header and if_range_allows(request, headers, file_stat):
+        ranges = parse_range_header(range_header, file_stat.st_size)
+        if ranges == []:
+            return Response(status_code=416, headers={"content-range": f"bytes */{file_stat.st_size}"})
+        if ranges:
+            return range_response(file_path, ranges, file_stat.st_size, media_type, headers)
+    # Whole-file responses go through FileResponse so servers offering pathsend/zero-copy can use it
+    return FileResponse(file_path, media_type=media_type, headers=headers, stat_result=file_stat)
+
+# Gallery image derivatives
+def build_image_derivatives(source: str, stem: str) -> Dict:
+    """Read an image's dimensions and write its resized variants. Runs in a worker process."""
+    variants = []
+    with Image.open(source) as original:
+        image = ImageOps.exif_transpose(original)
+        width, height = image.size
+        has_alpha = image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info)
+        fallback_format, fallback_extension = ("PNG", "png") if has_alpha else ("JPEG", "jpg")
+        image = image.convert("RGBA" if has_alpha else "RGB")
+        for target_width in [w for w in IMAGE_DERIVATIVE_WIDTHS if w < width] or [width]:
+            target_height = max(1, round(height * target_width / width))
+            resized = image.resize((target_width, target_height), Image.LANCZOS)
+            for image_format, extension in (("WEBP", "webp"), (fallback_format, fallback_extension)):
+                filename = f"{stem}_{target_width}w.{extension}"
+                path = UPLOAD_DIR / filename
+                # Identical uploads share derivatives, so they may already exist
+                if not path.exists():
+                    temp_path = UPLOAD_DIR / f".{uuid.uuid4()}.part"
+                    resized.save(temp_path, image_format, quality=80, optimize=True)
+                    os.replace(temp_path, path)
+                variants.append({
+                    "width": target_width,
+                    "height": target_height,
+                    "format": extension,
+                    "filename": filename,
+                    "file_size": path.stat().st_size
+                })
+    return {"width": width, "height": height, "variants": variants}
+
+def get_image_pool() -> ProcessPoolExecutor:
+    global image_pool
+    if image_pool is None:
+        # Forking a process that already runs Motor and thread pools can deadlock the child
+        image_pool = ProcessPoolExecutor(max_workers=IMAGE_WORKERS, mp_context=multiprocessing.get_context("forkserver"))
+    return image_pool
+
+async def generate_gallery_derivatives(image_id: str, filename: str):
+    """Fill in dimensions and variants for a gallery image without blocking the event loop"""
+    if Image is None:
+        return
+    try:
+        loop = asyncio.get_running_loop()
+        derived = await loop.run_in_executor(get_image_pool(), build_image_derivatives, str(UPLOAD_DIR / filename), filename.split(".")[0])
+        await db.gallery_images.update_one({"id": image_id}, {"$set": {**derived, "derivatives_status": "ready"}})
+    except Exception as e:
+        logging.getLogger(__name__).error(f"Could not build derivatives for gallery image {image_id}: {e}")
+        await db.gallery_images.update_one({"id": image_id}, {"$set": {"derivatives_status": "failed"}})
+
+def run_in_background(coroutine):
+    """Run a coroutine as a task, keeping a reference so it is not garbage collected"""
+    task = asyncio.create_task(coroutine)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+async def backfill_gallery_derivatives():
+    """Build derivatives for gallery images uploaded before the pipeline existed, or left pending by a worker that stopped"""
+    while True:
+        # Claim one image at a time so workers starting together split the backlog
+        now = datetime.now(timezone.utc)
+        image = await db.gallery_images.find_one_and_update(
+            {"$or": [
+                {"derivatives_status": None},
+                {"derivatives_status": "pending", "derivatives_claimed_at": {"$lt": now - timedelta(seconds=IMAGE_DERIVATIVE_CLAIM_TIMEOUT)}},
+                {"derivatives_status": "pending", "derivatives_claimed_at": None}
+            ]},
+            {"$set": {"derivatives_status": "pending", "derivatives_claimed_at": now}},
+            projection={"id": 1, "filename": 1}
+        )
+        if image is None:
+            return
+        await generate_gallery_derivatives(image["id"], image["filename"])
+
+def add_gallery_urls(image: Dict) -> Dict:
+    image["file_url"] = f"/api/uploads/{image['filename']}"
+    for variant in image.get("variants", []):
+        variant["url"] = f"/api/uploads/{variant['filename']}"
+    webp_variants = [variant for variant in image.get("variants", []) if variant["format"] == "webp"]
+    image["thumbnail_url"] = webp_variants[0]["url"] if webp_variants else image["file_url"]
+    return image
 
 # Gallery endpoints
 @api_router.get("/gallery")
@@ -1191,7 +3193,10 @@ async def get_gallery_images(
     tags: Optional[str] = None,
     featured_only: Optional[bool] = None,
     page: int = 1,
-    limit: int = 20
+    limit: int = 20,
+    pagination: str = "offset",
+    cursor: Optional[str] = None,
+    count: Optional[str] = None
 ):
     query = {}
     if search:
@@ -1206,22 +3211,27 @@ async def get_gallery_images(
     if featured_only:
         query["is_featured"] = True
     
-    total_count = await db.gallery_images.count_documents(query)
+    total_count = await count_matches(db.gallery_images, query, count_strategy("gallery", count))
+    if use_cursor_pagination(pagination, cursor):
+        images_raw, next_cursor, prev_cursor = await keyset_page(db.gallery_images, query, "created_at", cursor, limit)
+        return {
+            "images": [add_gallery_urls(GalleryImage(**img).dict()) for img in images_raw],
+            "pagination": cursor_pagination(limit, next_cursor, prev_cursor, total_count)
+        }
     skip = (page - 1) * limit
-    images_raw = await db.gallery_images.find(query).sort("created_at", -1).skip(skip).limit(limit).to_list(length=limit)
-    images = [GalleryImage(**img).dict() for img in images_raw]
-    
-    # Convert file paths to URLs
-    for img in images:
-        img["file_url"] = f"/api/uploads/{img['filename']}"
+    images_cursor = db.gallery_images.find(query).sort([("created_at", -1), ("id", -1)])
+    images_raw, has_next = await fetch_offset_page(images_cursor, skip, limit, total_count)
+    images = [add_gallery_urls(GalleryImage(**img).dict()) for img in images_raw]
     
+    if total_count is None:
+        return {"images": images, "pagination": {"current_page": page, "has_next": has_next, "has_prev": page > 1}}
     return {
         "images": images,
         "pagination": {
             "current_page": page,
             "total_pages": (total_count + limit - 1) // limit,
             "total_results": total_count,
-            "has_next": page * limit < total_count,
+            "has_next": has_next,
             "has_prev": page > 1
         }
     }
@@ -1241,19 +3251,12 @@ async def upload_gallery_image(
     if not file.content_type or not file.content_type.startswith('image/'):
         raise HTTPException(status_code=400, detail="Only image files are allowed")
     
-    settings = await db.settings.find_one()
-    max_size = settings["max_file_size"] if settings else 5368709120
+    max_size = (await get_site_settings()).max_file_size
     
-    file_extension = file.filename.split('.')[-1] if '.' in file.filename else ''
-    unique_filename = f"{uuid.uuid4()}.{file_extension}" if file_extension else str(uuid.uuid4())
+    stored = await store_upload(file, max_size)
+    unique_filename = stored["filename"]
     file_path = UPLOAD_DIR / unique_filename
     
-    async with aiofiles.open(file_path, 'wb') as f:
-        content = await file.read()
-        if len(content) > max_size:
-            raise HTTPException(status_code=413, detail="File too large")
-        await f.write(content)
-    
     # Parse tags
     tag_list = []
     if tags:
@@ -1265,30 +3268,31 @@ async def upload_gallery_image(
         description=description,
         filename=unique_filename,
         file_path=str(file_path),
-        file_size=len(content),
+        file_size=stored["size"],
         mime_type=file.content_type,
         tags=tag_list,
         is_featured=is_featured,
+        derivatives_status="pending" if Image is not None else None,
+        derivatives_claimed_at=datetime.now(timezone.utc) if Image is not None else None,
         uploaded_by=current_user
     )
     
-    await db.gallery_images.insert_one(gallery_image.dict())
+    try:
+        await db.gallery_images.insert_one(gallery_image.dict())
+    except BaseException:
+        # Nothing refers to the stored file yet
+        await release_blob(unique_filename)
+        raise
+    await apply_facet_diff(set(), gallery_facets(gallery_image.dict()))
+    invalidate_counts("gallery_images")
+    run_in_background(generate_gallery_derivatives(gallery_image.id, unique_filename))
     
-    result = gallery_image.dict()
-    result["file_url"] = f"/api/uploads/{unique_filename}"
-    return result
+    return add_gallery_urls(gallery_image.dict())
 
 @api_router.get("/gallery/tags")
 async def get_gallery_tags():
     """Get all unique tags used in gallery images"""
-    pipeline = [
-        {"$unwind": "$tags"},
-        {"$group": {"_id": "$tags", "count": {"$sum": 1}}},
-        {"$sort": {"count": -1}},
-        {"$project": {"name": "$_id", "count": 1, "_id": 0}}
-    ]
-    tags = await db.gallery_images.aggregate(pipeline).to_list(length=None)
-    return tags
+    return [{"name": entry["value"], "count": entry["count"]} for entry in await get_facet_counts("gallery_tags")]
 
 @api_router.get("/gallery/{image_id}")
 async def get_gallery_image(image_id: str):
@@ -1296,9 +3300,7 @@ async def get_gallery_image(image_id: str):
     if not image:
         raise HTTPException(status_code=404, detail="Image not found")
     
-    result = GalleryImage(**image).dict()
-    result["file_url"] = f"/api/uploads/{result['filename']}"
-    return result
+    return add_gallery_urls(GalleryImage(**image).dict())
 
 @api_router.put("/gallery/{image_id}")
 async def update_gallery_image(
@@ -1308,37 +3310,32 @@ async def update_gallery_image(
 ):
     await require_permission(current_user, "files_manage_all")
     
-    existing_image = await db.gallery_images.find_one({"id": image_id})
-    if not existing_image:
-        raise HTTPException(status_code=404, detail="Image not found")
-    
-    await db.gallery_images.update_one(
+    existing_image = await db.gallery_images.find_one_and_update(
         {"id": image_id},
-        {"$set": image_data.dict()}
+        {"$set": image_data.dict()},
+        return_document=ReturnDocument.BEFORE
     )
+    if not existing_image:
+        raise HTTPException(status_code=404, detail="Image not found")
+    updated_image = {**existing_image, **image_data.dict()}
+    await apply_facet_diff(gallery_facets(existing_image), gallery_facets(updated_image))
+    invalidate_counts("gallery_images")
     
-    updated_image = await db.gallery_images.find_one({"id": image_id})
-    result = GalleryImage(**updated_image).dict()
-    result["file_url"] = f"/api/uploads/{result['filename']}"
-    return result
+    return add_gallery_urls(GalleryImage(**updated_image).dict())
 
 @api_router.delete("/gallery/{image_id}")
 async def delete_gallery_image(image_id: str, current_user: str = Depends(get_current_user)):
     await require_permission(current_user, "files_delete")
     
-    image = await db.gallery_images.find_one({"id": image_id})
+    # Delete from database
+    image = await db.gallery_images.find_one_and_delete({"id": image_id})
     if not image:
         raise HTTPException(status_code=404, detail="Image not found")
+    await apply_facet_diff(gallery_facets(image), set())
+    invalidate_counts("gallery_images")
     
-    # Delete file from filesystem
-    file_path = UPLOAD_DIR / image["filename"]
-    if file_path.exists():
-        file_path.unlink()
-    
-    # Delete from database
-    result = await db.gallery_images.delete_one({"id": image_id})
-    if result.deleted_count == 0:
-        raise HTTPException(status_code=404, detail="Image not found")
+    # Delete file from filesystem once no other upload shares it
+    await release_blob(image["filename"])
     
     return {"message": "Image deleted successfully"}
 
@@ -1349,8 +3346,12 @@ async def get_analytics(
     search: Optional[str] = None,
     country: Optional[str] = None,
     page: int = 1,
-    limit: int = 50
+    limit: int = 50,
+    skip_facets: Optional[str] = None,
+    pagination: str = "offset",
+    cursor: Optional[str] = None
 ):
+    skipped = {facet.strip() for facet in skip_facets.split(",")} if skip_facets else set()
     query = {}
     if search:
         query["$or"] = [
@@ -1362,33 +3363,59 @@ async def get_analytics(
         ]
     if country and country != "all":
         query["country"] = country
-    total_visits = await db.analytics.count_documents(query)
-    unique_visitors = await db.analytics.distinct("ip_address", query)
+    if use_cursor_pagination(pagination, cursor):
+        # The visit page is an index seek on (timestamp, id); the facets never see it
+        if not query and await analytics_rollups_available():
+            summary = await get_rollup_summary()
+            for facet in skipped & set(ANALYTICS_OPTIONAL_FACETS):
+                summary[facet] = None
+        else:
+            summary = await get_analytics_facets(query, 0, limit, skipped, include_visits=False)
+        visits, next_cursor, prev_cursor = await keyset_page(db.analytics, query, "timestamp", cursor, limit)
+        return {
+            **summary,
+            "recent_visits": [Analytics(**visit).dict() for visit in visits],
+            "pagination": {**cursor_pagination(limit, next_cursor, prev_cursor), "total_results": summary["total_visits"]}
+        }
     skip = (page - 1) * limit
-    recent_visits_raw = await db.analytics.find(query).sort("timestamp", -1).skip(skip).limit(limit).to_list(length=limit)
-    recent_visits = [Analytics(**visit).dict() for visit in recent_visits_raw]
-    pipeline = [{"$match": query}, {"$group": {"_id": "$page_url", "count": {"$sum": 1}}}, {"$sort": {"count": -1}}, {"$limit": 10}]
-    top_pages = await db.analytics.aggregate(pipeline).to_list(length=10)
-    country_pipeline = [{"$match": query}, {"$group": {"_id": "$country", "count": {"$sum": 1}}}, {"$sort": {"count": -1}}, {"$limit": 10}]
-    top_countries = await db.analytics.aggregate(country_pipeline).to_list(length=10)
-    browser_pipeline = [{"$match": query}, {"$group": {"_id": "$browser", "count": {"$sum": 1}}}, {"$sort": {"count": -1}}, {"$limit": 10}]
-    top_browsers = await db.analytics.aggregate(browser_pipeline).to_list(length=10)
+    if not query and await analytics_rollups_available():
+        # Unfiltered dashboard: totals come from rollups, only the visit page touches raw data
+        summary = await get_rollup_summary()
+        recent_visits_raw = await db.analytics.find().sort([("timestamp", -1), ("id", -1)]).skip(skip).limit(limit).to_list(length=limit)
+        total_visits = summary["total_visits"]
+        for facet in skipped & set(ANALYTICS_OPTIONAL_FACETS):
+            summary[facet] = None
+        return {
+            **summary,
+            "recent_visits": [Analytics(**visit).dict() for visit in recent_visits_raw],
+            "pagination": {"current_page": page, "total_pages": (total_visits + limit - 1) // limit, "total_results": total_visits}
+        }
+    summary = await get_analytics_facets(query, skip, limit, skipped)
+    total_visits = summary["total_visits"]
     return {
-        "total_visits": total_visits,
-        "unique_visitors": len(unique_visitors),
-        "recent_visits": recent_visits,
-        "top_pages": top_pages,
-        "top_countries": top_countries,
-        "top_browsers": top_browsers,
+        **summary,
         "pagination": {"current_page": page, "total_pages": (total_visits + limit - 1) // limit, "total_results": total_visits}
     }
 
+@api_router.get("/analytics/ingestion")
+async def get_analytics_ingestion(current_user: str = Depends(get_current_user)):
+    """Counters for the buffered analytics pipeline"""
+    await require_permission(current_user, "analytics_view")
+    return {
+        **analytics_stats,
+        "buffered": len(analytics_buffer),
+        "buffer_size": ANALYTICS_BUFFER_SIZE,
+        "batch_size": ANALYTICS_BATCH_SIZE,
+        "flush_interval": ANALYTICS_FLUSH_INTERVAL,
+        "overflow_policy": ANALYTICS_OVERFLOW_POLICY,
+        "user_agent_cache": user_agent_cache_stats()
+    }
+
 # Contact endpoints
 @api_router.post("/contact")
 async def submit_contact(contact_data: ContactForm, request: Request):
     client_ip = request.client.host
-    settings = await db.settings.find_one() or {}
-    cooldown = settings.get("contact_cooldown", 300)
+    cooldown = (await get_site_settings()).contact_cooldown
     await check_rate_limit(client_ip, "contact", cooldown)
     contact = ContactMessage(
         name=contact_data.name,
@@ -1397,10 +3424,19 @@ async def submit_contact(contact_data: ContactForm, request: Request):
         ip_address=client_ip
     )
     await db.contact_messages.insert_one(contact.dict())
+    invalidate_counts("contact_messages")
     return {"message": "Contact message sent successfully"}
 
 @api_router.get("/contact-messages")
-async def get_contact_messages(current_user: str = Depends(get_current_user), page: int = 1, limit: int = 20, search: Optional[str] = None):
+async def get_contact_messages(
+    current_user: str = Depends(get_current_user),
+    page: int = 1,
+    limit: int = 20,
+    search: Optional[str] = None,
+    pagination: str = "offset",
+    cursor: Optional[str] = None,
+    count: Optional[str] = None
+):
     query = {}
     if search:
         query["$or"] = [
@@ -1408,9 +3444,15 @@ async def get_contact_messages(current_user: str = Depends(get_current_user), pa
             {"email": {"$regex": search, "$options": "i"}},
             {"message": {"$regex": search, "$options": "i"}}
         ]
-    total = await db.contact_messages.count_documents(query)
+    total = await count_matches(db.contact_messages, query, count_strategy("contact_messages", count))
+    if use_cursor_pagination(pagination, cursor):
+        messages, next_cursor, prev_cursor = await keyset_page(db.contact_messages, query, "created_at", cursor, limit)
+        return {"messages": [ContactMessage(**msg) for msg in messages], "pagination": cursor_pagination(limit, next_cursor, prev_cursor, total)}
     skip = (page - 1) * limit
-    messages = await db.contact_messages.find(query).sort("created_at", -1).skip(skip).limit(limit).to_list(length=limit)
+    messages_cursor = db.contact_messages.find(query).sort([("created_at", -1), ("id", -1)])
+    messages, has_next = await fetch_offset_page(messages_cursor, skip, limit, total)
+    if total is None:
+        return {"messages": [ContactMessage(**msg) for msg in messages], "pagination": {"current_page": page, "has_next": has_next, "has_prev": page > 1}}
     return {"messages": [ContactMessage(**msg) for msg in messages], "pagination": {"current_page": page, "total_pages": (total + limit - 1) // limit, "total_results": total}}
 
 @api_router.delete("/contact-messages/{message_id}")
@@ -1418,13 +3460,13 @@ async def delete_contact_message(message_id: str, current_user: str = Depends(ge
     result = await db.contact_messages.delete_one({"id": message_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Message not found")
+    invalidate_counts("contact_messages")
     return {"message": "Contact message deleted successfully"}
 
 # Settings endpoints
 @api_router.get("/settings")
 async def get_settings(current_user: str = Depends(get_current_user)):
-    settings = await db.settings.find_one()
-    return Settings(**settings) if settings else Settings()
+    return await get_site_settings()
 
 @api_router.put("/settings")
 async def update_settings(
@@ -1553,87 +3595,206 @@ async def update_settings(
     if default_author is not None:
         update_data["default_author"] = default_author
     
-    await db.settings.update_one({}, {"$set": update_data}, upsert=True)
+    # The version bump tells other workers to reload their cached copy
+    await db.settings.update_one({}, {"$set": update_data, "$inc": {"version": 1}}, upsert=True)
+    await load_settings()
     return {"message": "Settings updated successfully"}
 
 @api_router.get("/public-settings")
-async def public_settings():
-    s = await db.settings.find_one() or {}
+async def public_settings(request: Request):
+    if settings_cache["public_body"] is None:
+        await load_settings()
+    headers = {"etag": settings_cache["public_etag"], "cache-control": f"public, max-age={PUBLIC_SETTINGS_MAX_AGE}"}
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None and etag_matches(if_none_match, settings_cache["public_etag"]):
+        return Response(status_code=304, headers=headers)
+    return Response(content=settings_cache["public_body"], media_type="application/json", headers=headers)
+
+def public_settings_payload(s: Settings) -> dict:
+    """Settings the public site needs on every page load"""
     return {
-        "site_title": s.get("site_title", Settings().site_title),
-        "meta_description": s.get("meta_description", Settings().meta_description),
-        "meta_keywords": s.get("meta_keywords", Settings().meta_keywords),
-        "background_type": s.get("background_type", "default"),
-        "background_value": s.get("background_value"),
-        "background_image_url": s.get("background_image_url"),
-        "primary_color": s.get("primary_color", Settings().primary_color),
-        "secondary_color": s.get("secondary_color", Settings().secondary_color),
-        "accent_color": s.get("accent_color", Settings().accent_color),
-        "font_family": s.get("font_family", Settings().font_family),
-        "custom_css": s.get("custom_css"),
-        "google_analytics_id": s.get("google_analytics_id"),
-        "facebook_url": s.get("facebook_url"),
-        "twitter_url": s.get("twitter_url"),
-        "instagram_url": s.get("instagram_url"),
-        "linkedin_url": s.get("linkedin_url"),
-        "github_url": s.get("github_url"),
-        "youtube_url": s.get("youtube_url"),
-        "posts_per_page": s.get("posts_per_page", Settings().posts_per_page),
-        "enable_comments": s.get("enable_comments", Settings().enable_comments)
+        "site_title": s.site_title,
+        "meta_description": s.meta_description,
+        "meta_keywords": s.meta_keywords,
+        "background_type": s.background_type,
+        "background_value": s.background_value,
+        "background_image_url": s.background_image_url,
+        "primary_color": s.primary_color,
+        "secondary_color": s.secondary_color,
+        "accent_color": s.accent_color,
+        "font_family": s.font_family,
+        "custom_css": s.custom_css,
+        "google_analytics_id": s.google_analytics_id,
+        "facebook_url": s.facebook_url,
+        "twitter_url": s.twitter_url,
+        "instagram_url": s.instagram_url,
+        "linkedin_url": s.linkedin_url,
+        "github_url": s.github_url,
+        "youtube_url": s.youtube_url,
+        "posts_per_page": s.posts_per_page,
+        "enable_comments": s.enable_comments
     }
 
 @api_router.get("/robots.txt")
 async def get_robots_txt():
     """Serve robots.txt dynamically from settings"""
-    s = await db.settings.find_one() or {}
-    robots_content = s.get("robots_txt", Settings().robots_txt)
-    return {"content": robots_content}
+    return {"content": (await get_site_settings()).robots_txt}
+
+# Sitemap
+async def content_version() -> int:
+    state = await db.content_state.find_one({"_id": "content"})
+    return state["version"] if state else 0
+
+async def bump_content_version():
+    """Invalidate every worker's cached sitemap"""
+    await db.content_state.update_one({"_id": "content"}, {"$inc": {"version": 1}}, upsert=True)
+
+def sitemap_url(loc: str, lastmod: Optional[datetime], changefreq: str, priority: str) -> str:
+    lastmod_tag = f"<lastmod>{lastmod.strftime('%Y-%m-%d')}</lastmod>" if lastmod else ""
+    return f"<url><loc>{escape(loc)}</loc>{lastmod_tag}<changefreq>{changefreq}</changefreq><priority>{priority}</priority></url>\n"
+
+async def sitemap_counts() -> dict:
+    if sitemap_cache["counts"] is None:
+        sitemap_cache["counts"] = {
+            "posts": await db.blog_posts.count_documents({"published": True}),
+            "pages": await db.pages.count_documents({"is_homepage": {"$ne": True}})
+        }
+    return sitemap_cache["counts"]
+
+async def sitemap_entries(start: int, count: int, post_count: int):
+    """<url> elements start..start+count of the homepage, then published posts, then pages"""
+    projection = {"_id": 0, "slug": 1, "updated_at": 1, "created_at": 1}
+    if start == 0 and count > 0:
+        home = await db.pages.find_one({"is_homepage": True}, projection) or {}
+        yield sitemap_url(f"{BASE_URL}/", home.get("updated_at") or home.get("created_at"), "weekly", "1.0")
+        count -= 1
+    post_offset = max(start - 1, 0)
+    if count > 0 and post_offset < post_count:
+        posts = db.blog_posts.find({"published": True}, projection).sort([("created_at", -1), ("id", -1)]).skip(post_offset).limit(count)
+        async for post in posts:
+            yield sitemap_url(f"{BASE_URL}/blog/{quote(post['slug'])}", post.get("updated_at") or post.get("created_at"), "monthly", "0.8")
+            count -= 1
+    if count > 0:
+        pages = db.pages.find({"is_homepage": {"$ne": True}}, projection).sort("slug", 1).skip(max(start - 1 - post_count, 0)).limit(count)
+        async for page in pages:
+            yield sitemap_url(f"{BASE_URL}/{quote(page['slug'])}", page.get("updated_at") or page.get("created_at"), "monthly", "0.6")
+
+async def sitemap_urlset(start: int, count: int, post_count: int):
+    yield '<?xml version="1.0" encoding="UTF-8"?>\n<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
+    async for entry in sitemap_entries(start, count, post_count):
+        yield entry
+    yield "</urlset>\n"
+
+async def sitemap_index(parts: int):
+    yield '<?xml version="1.0" encoding="UTF-8"?>\n<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
+    for part in range(1, parts + 1):
+        yield f"<sitemap><loc>{escape(f'{BASE_URL}/api/sitemap-{part}.xml')}</loc></sitemap>\n"
+    yield "</sitemapindex>\n"
+
+async def sitemap_response(request: Request, name: str, version: int, xml) -> Response:
+    """Serve a sitemap file from the cache, or stream it from MongoDB while caching it"""
+    accepts_gzip = "gzip" in request.headers.get("accept-encoding", "")
+    etag = f'"sitemap-{version}-{name}"'
+    headers = {"etag": etag, "cache-control": f"public, max-age={SITEMAP_MAX_AGE}", "vary": "Accept-Encoding"}
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None and etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+    if accepts_gzip:
+        headers["content-encoding"] = "gzip"
+    cached = sitemap_cache["bodies"].get(name)
+    if cached is not None:
+        if not accepts_gzip:
+            return Response(content=cached[0], media_type="application/xml", headers=headers)
+        if cached[1] is None:
+            cached[1] = await asyncio.to_thread(gzip.compress, cached[0])
+        return Response(content=cached[1], media_type="application/xml", headers=headers)
+    
+    async def stream():
+        compressor = zlib.compressobj(wbits=31) if accepts_gzip else None  # gzip container
+        body, compressed, pending, size = [], [], [], 0
+        def encode(data: bytes, final: bool = False) -> bytes:
+            body.append(data)
+            if compressor is not None:
+                data = compressor.compress(data) + (compressor.flush() if final else b"")
+                compressed.append(data)
+            return data
+        async for fragment in xml:
+            pending.append(fragment.encode())
+            size += len(pending[-1])
+            if size >= SITEMAP_CHUNK_SIZE:
+                chunk = encode(b"".join(pending))
+                pending, size = [], 0
+                if chunk:
+                    yield chunk
+        chunk = encode(b"".join(pending), final=True)
+        if chunk:
+            yield chunk
+        if sitemap_cache["version"] == version:
+            sitemap_cache["bodies"][name] = [b"".join(body), b"".join(compressed) if compressor is not None else None]
+    
+    return StreamingResponse(stream(), media_type="application/xml", headers=headers)
+
+async def current_sitemap_version() -> int:
+    version = await content_version()
+    if sitemap_cache["version"] != version:
+        sitemap_cache.update({"version": version, "counts": None, "bodies": {}})
+    return version
 
 @api_router.get("/sitemap.xml")
-async def get_sitemap():
-    """Generate dynamic sitemap"""
-    base_url = "https://example.com"  # Should be configurable via environment variables
-    
-    # Get all published blog posts
-    posts = await db.blog_posts.find({"published": True}).sort("updated_at", -1).to_list(length=None)
-    
-    # Get all pages
-    pages = await db.pages.find().to_list(length=None)
-    
-    urls = []
-    
-    # Add homepage
-    urls.append({
-        "loc": base_url,
-        "lastmod": datetime.now(timezone.utc).strftime("%Y-%m-%d"),
-        "changefreq": "weekly",
-        "priority": "1.0"
-    })
-    
-    # Add blog posts
-    for post in posts:
-        urls.append({
-            "loc": f"{base_url}/blog/{post['slug']}",
-            "lastmod": post.get("updated_at", post.get("created_at")).strftime("%Y-%m-%d"),
-            "changefreq": "monthly",
-            "priority": "0.8"
-        })
-    
-    # Add pages
-    for page in pages:
-        if not page.get("is_homepage"):
-            urls.append({
-                "loc": f"{base_url}/{page['slug']}",
-                "lastmod": page.get("updated_at", page.get("created_at")).strftime("%Y-%m-%d"),
-                "changefreq": "monthly",
-                "priority": "0.6"
-            })
-    
-    return {"urls": urls}
+async def get_sitemap(request: Request):
+    """Sitemap of the site, or a sitemap index once it outgrows one file"""
+    version = await current_sitemap_version()
+    counts = await sitemap_counts()
+    total = 1 + counts["posts"] + counts["pages"]
+    if total <= SITEMAP_MAX_URLS:
+        return await sitemap_response(request, "sitemap", version, sitemap_urlset(0, total, counts["posts"]))
+    return await sitemap_response(request, "index", version, sitemap_index(math.ceil(total / SITEMAP_MAX_URLS)))
+
+@api_router.get("/sitemap-{part}.xml")
+async def get_sitemap_part(part: int, request: Request):
+    version = await current_sitemap_version()
+    counts = await sitemap_counts()
+    total = 1 + counts["posts"] + counts["pages"]
+    if part < 1 or (part - 1) * SITEMAP_MAX_URLS >= total:
+        raise HTTPException(status_code=404, detail="Sitemap not found")
+    xml = sitemap_urlset((part - 1) * SITEMAP_MAX_URLS, SITEMAP_MAX_URLS, counts["posts"])
+    return await sitemap_response(request, f"part-{part}", version, xml)
 
 @app.on_event("startup")
 async def startup_event():
+    await init_password_hashing()
+    await ensure_indexes()
     await initialize_data()
+    await init_tag_counts()
+    await repair_analytics_timestamps()
+    await init_analytics_rollups()
+    await start_analytics_flusher()
+    await refresh_token_versions()
+    await load_settings()
+    response_cache.init_disk()
+    global upload_gc_task, token_version_task, settings_poll_task, cache_sweep_task
+    upload_gc_task = asyncio.create_task(upload_session_gc())
+    cache_sweep_task = asyncio.create_task(cache_sweeper())
+    token_version_task = asyncio.create_task(token_version_refresher())
+    settings_poll_task = asyncio.create_task(settings_poller())
+    if Image is not None:
+        run_in_background(backfill_gallery_derivatives())
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await stop_analytics_flusher()
+    if upload_gc_task is not None:
+        upload_gc_task.cancel()
+    if token_version_task is not None:
+        token_version_task.cancel()
+    if settings_poll_task is not None:
+        settings_poll_task.cancel()
+    if cache_sweep_task is not None:
+        cache_sweep_task.cancel()
+    response_cache.close_disk()
+    if image_pool is not None:
+        image_pool.shutdown(wait=False, cancel_futures=True)
+    password_pool.shutdown(wait=False, cancel_futures=True)
 
 # Health check endpoint
 @api_router.get("/health")
@@ -1647,12 +3808,39 @@ async def health_check():
 
 app.include_router(api_router)
 
+# Form uploads: FastAPI spools the whole multipart body before the endpoint runs
+FORM_UPLOAD_PATHS = {"/api/upload", "/api/gallery"}
+UPLOAD_FORM_OVERHEAD = 64 * 1024  # multipart boundaries and the form's text fields
+
+class UploadSizeLimitMiddleware:
+    """Reject oversized form uploads from their Content-Length before the body is read"""
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["method"] == "POST" and scope["path"] in FORM_UPLOAD_PATHS:
+            headers = dict(scope["headers"])
+            content_length = headers.get(b"content-length", b"").decode()
+            max_size = (await get_site_settings()).max_file_size
+            response = None
+            if not content_length.isdigit():
+                response = JSONResponse(status_code=411, content={"detail": "Content-Length required, use /api/uploads/multipart to stream uploads"})
+            elif int(content_length) > max_size + UPLOAD_FORM_OVERHEAD:
+                response = JSONResponse(status_code=413, content={"detail": "File too large"})
+            if response is not None:
+                await response(scope, receive, send)
+                return
+        await self.app(scope, receive, send)
+
+app.add_middleware(UploadSizeLimitMiddleware)
+
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Link"],
 )
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
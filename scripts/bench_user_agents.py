@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+Benchmark for parse_user_agent: per-visit CPU cost with and without the cache.
+
+The corpus mimics production traffic: a few hundred distinct user agent strings
+with a heavily skewed (Zipf-like) popularity distribution.
+
+Usage: python scripts/bench_user_agents.py [visits]
+"""
+
+import os
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "bench")
+
+import server  # noqa: E402
+
+CHROME = "Mozilla/5.0 ({platform}) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/{version}.0.0.0 Safari/537.36"
+FIREFOX = "Mozilla/5.0 ({platform}; rv:{version}.0) Gecko/20100101 Firefox/{version}.0"
+SAFARI = "Mozilla/5.0 ({platform}) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/{version}.0 Safari/605.1.15"
+BOTS = [
+    "Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)",
+    "Mozilla/5.0 (compatible; bingbot/2.0; +http://www.bing.com/bingbot.htm)",
+    "Mozilla/5.0 (compatible; AhrefsBot/7.0; +http://ahrefs.com/robot/)",
+    "curl/8.4.0",
+    "python-requests/2.31.0",
+]
+PLATFORMS = [
+    "Windows NT 10.0; Win64; x64",
+    "Macintosh; Intel Mac OS X 10_15_7",
+    "X11; Linux x86_64",
+    "iPhone; CPU iPhone OS 17_1 like Mac OS X",
+    "Linux; Android 14; Pixel 8",
+    "Linux; Android 13; SM-S911B",
+]
+
+
+def build_corpus(visits: int, seed: int = 42):
+    distinct = list(BOTS)
+    for platform in PLATFORMS:
+        for version in range(100, 125):
+            distinct.append(CHROME.format(platform=platform, version=version))
+            distinct.append(FIREFOX.format(platform=platform, version=version))
+        for version in range(14, 18):
+            distinct.append(SAFARI.format(platform=platform, version=version))
+    rng = random.Random(seed)
+    rng.shuffle(distinct)
+    weights = [1 / (rank + 1) for rank in range(len(distinct))]
+    return distinct, rng.choices(distinct, weights=weights, k=visits)
+
+
+def bench(label, func, corpus):
+    start = time.perf_counter()
+    for user_agent in corpus:
+        func(user_agent)
+    elapsed = time.perf_counter() - start
+    print(f"{label:<10} {elapsed:8.3f}s total  {elapsed / len(corpus) * 1e6:9.2f} us/visit")
+    return elapsed
+
+
+def main():
+    visits = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    distinct, corpus = build_corpus(visits)
+    print(f"{visits} visits over {len(distinct)} distinct user agents")
+
+    uncached = bench("uncached", server._parse_user_agent_uncached, corpus)
+    server._parse_user_agent_cached.cache_clear()
+    cached = bench("cached", server.parse_user_agent, corpus)
+
+    print(f"speedup    {uncached / cached:8.1f}x")
+    print(f"cache      {server.user_agent_cache_stats()}")
+
+
+if __name__ == "__main__":
+    main()
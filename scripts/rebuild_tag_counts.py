@@ -0,0 +1,26 @@
+#!/usr/bin/env python3
+"""
+Recount the blog/gallery tag and author counters (tag_counts) from the source collections.
+
+Run after editing blog_posts or gallery_images outside the API. Running servers keep
+serving cached tag listings until their response cache entries expire.
+
+Usage: python scripts/rebuild_tag_counts.py
+"""
+
+import asyncio
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import server  # noqa: E402
+
+
+async def main():
+    result = await server.rebuild_tag_counts()
+    print(f"{result['corrected']} counters corrected")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
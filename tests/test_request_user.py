@@ -0,0 +1,216 @@
+"""
+Round-trip budget for authenticated endpoints: the acting user's document is read from
+MongoDB at most once per request, however many permission checks the handler runs.
+
+Usage: python -m pytest tests/test_request_user.py
+"""
+
+import os
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "test")
+
+from fastapi.testclient import TestClient  # noqa: E402
+from pymongo import ReturnDocument  # noqa: E402
+
+import server  # noqa: E402
+
+
+def matches(doc, query):
+    for field, condition in (query or {}).items():
+        value = doc.get(field)
+        if isinstance(condition, dict):
+            if "$ne" in condition and value == condition["$ne"]:
+                return False
+            if "$in" in condition and value not in condition["$in"]:
+                return False
+        elif value != condition:
+            return False
+    return True
+
+
+def apply_update(doc, update):
+    doc.update(update.get("$set", {}))
+    for field, amount in update.get("$inc", {}).items():
+        doc[field] = doc.get(field, 0) + amount
+
+
+class FakeCursor:
+    def __init__(self, docs):
+        self.docs = docs
+
+    def sort(self, *args, **kwargs):
+        return self
+
+    def skip(self, count):
+        self.docs = self.docs[count:]
+        return self
+
+    def limit(self, count):
+        self.docs = self.docs[:count] if count else self.docs
+        return self
+
+    async def to_list(self, length=None):
+        return self.docs
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for doc in self.docs:
+            yield doc
+
+
+class FakeCollection:
+    """Just enough of a Motor collection, recording every round-trip as (collection, method, filter)"""
+
+    def __init__(self, name, calls):
+        self.name = name
+        self.calls = calls
+        self.docs = []
+
+    def _record(self, method, query=None):
+        self.calls.append((self.name, method, query or {}))
+
+    def _first(self, query):
+        return next((doc for doc in self.docs if matches(doc, query)), None)
+
+    async def find_one(self, query=None, projection=None, **kwargs):
+        self._record("find_one", query)
+        doc = self._first(query)
+        return dict(doc) if doc else None
+
+    def find(self, query=None, projection=None, **kwargs):
+        self._record("find", query)
+        return FakeCursor([dict(doc) for doc in self.docs if matches(doc, query)])
+
+    async def insert_one(self, doc):
+        self._record("insert_one")
+        self.docs.append(dict(doc))
+
+    async def update_one(self, query, update, upsert=False):
+        self._record("update_one", query)
+        doc = self._first(query)
+        if doc is None and upsert:
+            doc = {field: value for field, value in query.items() if not isinstance(value, dict)}
+            self.docs.append(doc)
+        if doc is not None:
+            apply_update(doc, update)
+        return SimpleNamespace(matched_count=int(doc is not None), modified_count=int(doc is not None))
+
+    async def find_one_and_update(self, query, update, projection=None, upsert=False, return_document=ReturnDocument.BEFORE):
+        self._record("find_one_and_update", query)
+        doc = self._first(query)
+        if doc is None:
+            return None
+        before = dict(doc)
+        apply_update(doc, update)
+        return dict(doc) if return_document == ReturnDocument.AFTER else before
+
+    async def find_one_and_delete(self, query, projection=None):
+        self._record("find_one_and_delete", query)
+        doc = self._first(query)
+        if doc is not None:
+            self.docs.remove(doc)
+        return doc
+
+    async def delete_one(self, query):
+        self._record("delete_one", query)
+        doc = self._first(query)
+        if doc is not None:
+            self.docs.remove(doc)
+        return SimpleNamespace(deleted_count=int(doc is not None))
+
+    async def delete_many(self, query):
+        self._record("delete_many", query)
+        return SimpleNamespace(deleted_count=0)
+
+    async def bulk_write(self, operations, ordered=True):
+        self._record("bulk_write")
+        return SimpleNamespace(modified_count=0, upserted_count=0)
+
+
+class FakeDatabase:
+    def __init__(self):
+        self.calls = []
+        self.collections = {}
+
+    def __getitem__(self, name):
+        if name not in self.collections:
+            self.collections[name] = FakeCollection(name, self.calls)
+        return self.collections[name]
+
+    def __getattr__(self, name):
+        return self[name]
+
+
+EDITOR = {
+    "id": "editor-id",
+    "username": "editor",
+    "email": "editor@example.com",
+    "display_name": "Editor",
+    "password_hash": "unused",
+    "is_owner": False,
+    "is_active": True,
+    "permissions": server.encode_permissions(server.UserPermissions(
+        blog_write_new=True,
+        blog_edit_own=True,
+        blog_edit_all=True,
+        blog_delete_posts=True,
+        users_view=True,
+        users_create=True,
+        users_edit=True,
+        users_delete=True
+    )),
+    "token_version": 0
+}
+OTHER = {"id": "other-id", "username": "other", "email": "other@example.com", "is_owner": False, "is_active": True, "permissions": 0, "token_version": 0}
+POST = {"id": "post-id", "slug": "hello", "title": "Hello", "content": "<p>Hello</p>", "excerpt": "Hello", "tags": ["news"], "author": "Editor", "published": True}
+
+# Endpoint, request body and the most MongoDB round-trips it may make in total
+ENDPOINTS = [
+    ("GET", "/api/me", None, 2),
+    ("POST", "/api/blog", {"title": "New", "slug": "new", "content": "<p>New</p>", "excerpt": "New", "author": "Editor"}, 5),
+    ("PUT", "/api/blog/post-id", {"title": "Edited", "content": "<p>Edited</p>", "excerpt": "Edited", "tags": ["news"], "author": "Editor"}, 4),
+    ("DELETE", "/api/blog/post-id", None, 5),
+    ("POST", "/api/users", {"username": "new", "email": "new@example.com", "password": "correct horse"}, 4),
+    ("PUT", "/api/users/other-id", {"display_name": "Renamed"}, 3),
+    ("DELETE", "/api/users/other-id", None, 3),
+]
+
+
+@pytest.fixture
+def fake_db(monkeypatch):
+    fake = FakeDatabase()
+    fake.users.docs.extend([dict(EDITOR), dict(OTHER)])
+    fake.blog_posts.docs.append(dict(POST))
+    monkeypatch.setattr(server, "db", fake)
+    # As primed by refresh_token_versions at startup
+    monkeypatch.setattr(server, "token_versions", {"editor": 0, "other": 0})
+    server.permission_cache.clear()
+    yield fake
+    server.permission_cache.clear()
+
+
+def acting_user_reads(fake):
+    return [
+        call for call in fake.calls
+        if call[0] == "users" and call[1] == "find_one"
+        and (call[2].get("username") == EDITOR["username"] or call[2].get("id") == EDITOR["id"])
+    ]
+
+
+@pytest.mark.parametrize("method, path, body, budget", ENDPOINTS)
+def test_acting_user_is_read_at_most_once(fake_db, method, path, body, budget):
+    client = TestClient(server.app)
+    token = server.create_token(EDITOR)
+    response = client.request(method, path, json=body, headers={"Authorization": f"Bearer {token}"})
+    assert response.status_code == 200, response.text
+    assert len(acting_user_reads(fake_db)) <= 1, fake_db.calls
+    assert len(fake_db.calls) <= budget, fake_db.calls